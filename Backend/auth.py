@@ -1,20 +1,74 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from fastapi import Cookie, Depends, HTTPException
 from passlib.context import CryptContext
-from typing import Optional
+from typing import Optional, Tuple
+from services.cache import TTLCache
+from metrics import password_hash_duration, password_hash_wait
+import hashlib
+import time
 import jwt
 import os
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: il costo di bcrypt è configurabile, gli hash con un costo diverso vengono aggiornati al login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt impegna la CPU per centinaia di ms: gira in un pool dedicato, con un limite di operazioni contemporanee
+# e un'attesa massima oltre la quale la richiesta viene rifiutata con 429
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="bcrypt")
+_hash_semaphore = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
 
 SECRET_KEY = os.getenv("JWT_SECRET", "dev-secret")
 ALGORITHM = "HS256"
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+# Cache dei token già verificati: chiave = digest del token, scadenza = min(exp del token, TOKEN_CACHE_TTL)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Utente autenticato ricavato dal cookie access_token.
+    """
+    user_id: str
+    email: Optional[str]
+    expires_at: int
+    payload: dict
+
+async def _run_password_job(operation: str, func, *args):
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(_hash_semaphore.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=429,
+            detail="Troppe richieste di autenticazione, riprova tra poco",
+            headers={"Retry-After": "1"}
+        )
+    finally:
+        password_hash_wait.observe(time.perf_counter() - started)
+    try:
+        with password_hash_duration.time(operation):
+            return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        _hash_semaphore.release()
+
+async def hash_password(password: str) -> str:
+    return await _run_password_job("hash", pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifica la password e ritorna (valida, nuovo_hash). nuovo_hash è valorizzato quando l'hash
+    salvato va aggiornato (CryptContext.needs_update), ad es. dopo un cambio di BCRYPT_ROUNDS.
+    """
+    return await _run_password_job("verify", pwd_context.verify_and_update, plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_minutes: int = 60):
     to_encode = data.copy()
@@ -33,27 +87,48 @@ def decode_access_token(token: str) -> Optional[dict]:
         # Token invalido
         return None
 
-def get_user_id_from_token(token: str) -> Optional[str]:
+def decode_principal(token: str) -> Optional[Principal]:
     """
-    Decodifica il JWT e ritorna l'user_id, oppure None se invalido.
+    Verifica il JWT e ritorna il Principal, oppure None se invalido o scaduto.
+    I token già verificati vengono letti dalla cache senza rifare la verifica HMAC.
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    principal = token_cache.get(key)
+    if principal:
+        return principal
+
+    payload = decode_access_token(token)
+    if not payload or not payload.get("sub"):
         return None
 
-def get_email_from_token(token: str) -> Optional[str]:
+    principal = Principal(
+        user_id=payload["sub"],
+        email=payload.get("email"),
+        expires_at=payload["exp"],
+        payload=payload
+    )
+
+    # La voce in cache non deve sopravvivere alla scadenza del token
+    remaining = principal.expires_at - time.time()
+    if remaining > 0:
+        token_cache.set(key, principal, ttl=min(remaining, TOKEN_CACHE_TTL))
+
+    return principal
+
+async def get_principal(access_token: str = Cookie(None)) -> Optional[Principal]:
     """
-    Decodifica il JWT e ritorna la email, oppure None se invalido.
+    Dipendenza FastAPI: decodifica il cookie access_token una sola volta per richiesta.
+    Ritorna None se il token manca o non è valido. È async perché non fa I/O: una dipendenza sync
+    verrebbe eseguita nel threadpool ad ogni richiesta autenticata.
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("email")
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
+    if not access_token:
         return None
-    
+    return decode_principal(access_token)
+
+async def require_principal(principal: Optional[Principal] = Depends(get_principal)) -> Principal:
+    """
+    Dipendenza FastAPI per le route che richiedono un utente autenticato (401 altrimenti).
+    """
+    if not principal:
+        raise HTTPException(status_code=401, detail="Utente non autenticato")
+    return principal
@@ -1,20 +1,51 @@
 import os
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
 from dotenv import load_dotenv
+from metrics import mongo_listener
+from tracing import TRACING_ENABLED, mongo_trace_listener
+from logging_config import get_logger
 
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Creazione connessione db
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
 
-client = MongoClient(MONGO_URI)
+# Dimensioni del pool di connessioni, configurabili da variabili d'ambiente
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+
+# Le operazioni multiple sugli appuntamenti possono usare una transazione, che richiede replica set o Atlas:
+# disattivata di default perché un mongod standalone (il setup locale) la rifiuta
+MONGO_TRANSACTIONS = os.getenv("MONGO_TRANSACTIONS", "false").lower() == "true"
+
+# Client asincrono: le query non bloccano l'event loop di uvicorn
+client = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    # Durata dei comandi esposta su /metrics e, se il tracing è attivo, uno span per comando
+    event_listeners=[mongo_listener, mongo_trace_listener] if TRACING_ENABLED else [mongo_listener],
+)
 db = client[MONGO_DB_NAME]
 
 users = db["users"]
 user_agents = db["user_agents"]
 appointments = db["appointments"]
 messages = db["messages"]
+shared_blocks = db["shared_blocks"]
+provisioning_jobs = db["provisioning_jobs"]
+tool_registry = db["tool_registry"]
+mfa_challenges = db["mfa_challenges"]
+
+logger.info("Connected to MongoDB database", extra={"database": MONGO_DB_NAME})
 
-print(f"Connected to MongoDB database: {MONGO_DB_NAME}")
+async def close_db():
+    await client.close()
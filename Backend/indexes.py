@@ -0,0 +1,176 @@
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from db import db
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Indici dichiarati per ogni collection, uno per ogni pattern di accesso usato dalle route.
+# La dichiarazione è la fonte di verità: all'avvio vengono creati quelli mancanti e segnalati quelli cambiati,
+# che si allineano con scripts/rebuild_indexes.py.
+INDEXES = {
+    "users": [
+        # auth_routes.register / login
+        IndexModel([("email", ASCENDING)], name="email"),
+        # mfa_routes.mfa_login_complete. Unique: un credential_id identifica una sola chiave di un solo utente.
+        # Il filtro esclude gli utenti senza chiavi, che altrimenti sarebbero tutti indicizzati come duplicati di null
+        IndexModel(
+            [("webauthn_credentials.credential_id", ASCENDING)], name="webauthn_credential_id", unique=True,
+            partialFilterExpression={"webauthn_credentials.credential_id": {"$exists": True}}
+        ),
+    ],
+    "user_agents": [
+        # agent_service.get_or_create_agent: un solo agente (e una sola lease di creazione) per utente
+        IndexModel([("user_id", ASCENDING)], name="user_id", unique=True),
+    ],
+    "shared_blocks": [
+        # blocchi Letta condivisi, creati una sola volta per contenuto
+        IndexModel([("content_hash", ASCENDING)], name="content_hash", unique=True),
+    ],
+    "tool_registry": [
+        # ultima versione registrata su Letta di ogni tool
+        IndexModel([("name", ASCENDING)], name="name", unique=True),
+    ],
+    "provisioning_jobs": [
+        # un job di creazione agente per utente
+        IndexModel([("user_id", ASCENDING)], name="user_id", unique=True),
+        # presa in carico del prossimo job pronto
+        IndexModel([("status", ASCENDING), ("next_run_at", ASCENDING)], name="status_next_run_at"),
+    ],
+    "appointments": [
+        # un inizio (UTC) può essere prenotato una sola volta: garantisce l'atomicità di create/update_appointment
+        # e serve le scansioni per intervallo di slot e disponibilità. I documenti non ancora migrati (senza start) sono esclusi.
+        IndexModel([("start", ASCENDING)], name="start", unique=True, partialFilterExpression={"start": {"$type": "date"}}),
+        # appuntamenti di un utente in ordine cronologico, anche limitati a un intervallo
+        IndexModel([("user_id", ASCENDING), ("start", ASCENDING)], name="user_id_start"),
+    ],
+    "mfa_challenges": [
+        # sfide WebAuthn abbandonate eliminate alla scadenza (store di default, MFA_CHALLENGE_BACKEND=mongo)
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", expireAfterSeconds=0),
+    ],
+    "messages": [
+        # storico messaggi di un utente, paginato a chiave su (created_at, _id)
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="user_id_created_at_id"),
+    ],
+}
+
+# Opzioni che, se diverse, rendono un indice esistente non conforme alla dichiarazione
+COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def _index_key(spec: dict) -> list:
+    # IndexModel usa un dict {campo: direzione}, index_information una lista di coppie
+    key = spec["key"]
+    items = key.items() if isinstance(key, dict) else key
+    return [(field, int(direction)) if isinstance(direction, (int, float)) else (field, direction) for field, direction in items]
+
+
+def _same_index(declared: dict, existing: dict) -> bool:
+    if _index_key(declared) != _index_key(existing):
+        return False
+    return all(declared.get(opt) == existing.get(opt) for opt in COMPARED_OPTIONS)
+
+
+def _conflicting(declared: dict, existing: dict) -> list:
+    # Indici esistenti con lo stesso nome o le stesse chiavi di quello dichiarato
+    return [
+        index_name for index_name, info in existing.items()
+        if index_name != "_id_" and (index_name == declared["name"] or _index_key(info) == _index_key(declared))
+    ]
+
+
+async def _has_duplicates(collection, declared: dict) -> bool:
+    # Un indice unique non può essere creato se i dati esistenti hanno già valori duplicati
+    fields = [field for field, _ in _index_key(declared)]
+    pipeline = []
+    if declared.get("partialFilterExpression"):
+        pipeline.append({"$match": declared["partialFilterExpression"]})
+    if any("." in field for field in fields):
+        # Campi dentro array (es. webauthn_credentials.credential_id): un valore per elemento
+        pipeline.append({"$unwind": "$" + fields[0].split(".")[0]})
+    # Si contano i documenti distinti: lo stesso valore ripetuto in un solo documento non viola l'indice unique
+    pipeline += [
+        {"$group": {"_id": {f"k{i}": "$" + field for i, field in enumerate(fields)}, "docs": {"$addToSet": "$_id"}}},
+        {"$match": {"docs.1": {"$exists": True}}},
+        {"$limit": 1},
+    ]
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(length=1) != []
+
+
+async def _rebuild_index(collection, model: IndexModel, stale: list):
+    """
+    Sostituisce gli indici non conformi con quello dichiarato senza lasciare la collection senza indice:
+    prima viene creato un indice ponte sulle stesse chiavi più _id (chiavi diverse, quindi può coesistere con il vecchio),
+    poi vengono rimossi i vecchi e creato quello dichiarato. Se la creazione fallisce il ponte resta al suo posto.
+    """
+    declared = model.document
+    bridge_name = f"{declared['name']}_rebuild"
+    await collection.create_index(_index_key(declared) + [("_id", ASCENDING)], name=bridge_name)
+    for index_name in stale:
+        await collection.drop_index(index_name)
+    await collection.create_indexes([model])
+    await collection.drop_index(bridge_name)
+
+
+async def ensure_collection_indexes(name: str, models: list, rebuild: bool = False, dry_run: bool = False) -> dict:
+    """
+    Crea gli indici dichiarati mancanti e restituisce il report delle differenze. Gli indici esistenti con chiavi
+    o opzioni diverse dalla dichiarazione vengono solo segnalati (drift); con rebuild=True vengono sostituiti.
+    Con dry_run=True non viene modificato nulla: gli indici mancanti sono segnalati in "missing".
+    """
+    collection = db[name]
+    existing = await collection.index_information()
+    report = {"created": [], "missing": [], "drift": [], "rebuilt": [], "extra": [], "failed": []}
+
+    for model in models:
+        declared = model.document
+        current = existing.get(declared["name"])
+
+        if current is not None and _same_index(declared, current):
+            continue
+
+        try:
+            stale = _conflicting(declared, existing)
+            if not stale and dry_run:
+                report["missing"].append(declared["name"])
+            elif not stale:
+                await collection.create_indexes([model])
+                report["created"].append(declared["name"])
+            elif not rebuild or dry_run:
+                report["drift"].append(f"{declared['name']}: diverso da {', '.join(stale)}")
+            elif declared.get("unique") and await _has_duplicates(collection, declared):
+                # Il vecchio indice resta: ricrearlo come unique fallirebbe comunque
+                report["failed"].append(f"{declared['name']}: valori duplicati, l'indice unique non può essere creato")
+            else:
+                await _rebuild_index(collection, model, stale)
+                report["rebuilt"].append(declared["name"])
+        except OperationFailure as e:
+            # Es. indice unique su dati già duplicati: non blocca l'avvio, viene segnalato nel report
+            report["failed"].append(f"{declared['name']}: {e.details.get('errmsg') if e.details else e}")
+
+    # Indici non dichiarati e non già segnalati come drift (compreso un eventuale ponte rimasto da un rebuild fallito)
+    existing = await collection.index_information()
+    known = {index_name for model in models for index_name in _conflicting(model.document, existing)}
+    known |= {model.document["name"] for model in models}
+    report["extra"] = [index_name for index_name in existing if index_name != "_id_" and index_name not in known]
+
+    return report
+
+
+async def ensure_indexes(rebuild: bool = False, dry_run: bool = False) -> dict:
+    """
+    Crea in modo idempotente gli indici dichiarati in INDEXES mancanti e segnala le differenze (drift) rispetto al db.
+    All'avvio gli indici esistenti non vengono mai rimossi: la sostituzione (rebuild=True) si esegue con scripts/rebuild_indexes.py.
+    """
+    reports = {}
+    for name, models in INDEXES.items():
+        report = await ensure_collection_indexes(name, models, rebuild, dry_run)
+        reports[name] = report
+
+        for kind in ("created", "rebuilt", "missing", "drift", "extra", "failed"):
+            if report[kind]:
+                log = logger.warning if kind in ("missing", "drift", "extra", "failed") else logger.info
+                log(f"Indici {name} ({kind})", extra={"collection": name, "indexes": report[kind]})
+
+    return reports
@@ -0,0 +1,176 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from tracing import current_span
+
+# Log strutturati in JSON (una riga per evento) su stdout. I moduli usano get_logger(__name__):
+# il record viene formattato e ripulito dai dati sensibili nel chiamante, poi messo in una coda;
+# la scrittura su stdout avviene in un thread separato, così un terminale o un collector lento non blocca l'event loop.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Livelli per modulo, es. "routes.letta_router=DEBUG,pymongo=WARNING". Di default httpx (client Letta)
+# resta a WARNING: a INFO scriverebbe una riga per ogni richiesta verso Letta
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING,httpcore=WARNING")
+# Frazione degli eventi DEBUG registrati: per turno di chat (tutti o nessuno dello stesso trace) o casuale fuori da una traccia
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+REDACTED = "[REDACTED]"
+# Campi il cui valore non viene mai scritto nei log
+SENSITIVE_KEYS = ("password", "token", "secret", "authorization", "cookie", "api_key", "jwt")
+JWT_PATTERN = re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*")
+BEARER_PATTERN = re.compile(r"(?i)\b(bearer)\s+[\w.~+/=-]+")
+EMAIL_PATTERN = re.compile(r"\b([\w.%+-])[\w.%+-]*@([\w-]+(?:\.[\w-]+)+)")
+
+# Attributi standard di un LogRecord: tutto il resto (passato con extra=) diventa un campo del JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+def _is_sensitive(key: str) -> bool:
+    key = key.lower()
+    return any(name in key for name in SENSITIVE_KEYS)
+
+def redact(value):
+    """
+    Maschera token JWT, header Bearer ed email nelle stringhe e i valori delle chiavi sensibili nei dict.
+    """
+    if isinstance(value, str):
+        value = JWT_PATTERN.sub(REDACTED, value)
+        value = BEARER_PATTERN.sub(rf"\1 {REDACTED}", value)
+        return EMAIL_PATTERN.sub(r"\1***@\2", value)
+    if isinstance(value, dict):
+        return {key: REDACTED if _is_sensitive(str(key)) else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [redact(item) for item in value]
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return redact(str(value))
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        span = getattr(record, "span", None)
+        if span is not None:
+            event["trace_id"] = span.trace_id
+            event["span_id"] = span.span_id
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != "span":
+                event[key] = REDACTED if _is_sensitive(key) else redact(value)
+
+        if record.exc_info:
+            event["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """
+    Lascia passare tutti gli eventi da INFO in su e una frazione di quelli DEBUG. Aggiunge al record lo span attivo,
+    letto qui perché il contesto del chiamante non è più disponibile nel thread che scrive i log.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = current_span.get()
+        record.span = span
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        if span is not None:
+            # Decisione stabile per trace: un turno di chat campionato ha tutti i suoi eventi DEBUG
+            return int(span.trace_id[-8:], 16) < self.rate * 0x100000000
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler con coda limitata: se il thread di scrittura resta indietro gli eventi vengono scartati e contati
+    invece di bloccare il chiamante.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> str:
+        # La riga JSON viene prodotta qui, nel contesto del chiamante: il listener deve solo scriverla
+        return self.format(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LineHandler(logging.StreamHandler):
+    # Scrive le righe già formattate ricevute dalla coda
+
+    def handle(self, line) -> bool:
+        self.acquire()
+        try:
+            self.stream.write(line + self.terminator)
+            self.flush()
+        except Exception:
+            pass
+        finally:
+            self.release()
+        return True
+
+
+_queue_handler = None
+_listener = None
+
+
+def configure_logging():
+    """
+    Configura il root logger (idempotente): coda, thread di scrittura su stdout e livelli per modulo.
+    """
+    global _queue_handler, _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.setFormatter(JsonFormatter())
+    _queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _listener = QueueListener(log_queue, _LineHandler(sys.stdout))
+    _listener.start()
+    # Allo spegnimento del processo vengono scritti gli eventi ancora in coda
+    atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def logging_stats() -> dict:
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped": _queue_handler.dropped if _queue_handler else 0,
+    }
@@ -5,7 +5,18 @@ from routes.appointment_routes import router as appointment_routes
 from routes.letta_router import router as letta_router
 from routes.frontend_routes import router as frontend_routes
 from routes.mfa_routes import router as mfa_routes
-from services.agent_service import register_tools_on_startup
+from routes.metrics_routes import router as metrics_routes
+from routes.appointment_routes import slots_cache
+from services.agent_service import register_tools_on_startup, start_tools_registration, TOOLS_REGISTER_BACKGROUND, agent_cache
+from services.credential_service import credential_cache
+from auth import token_cache
+from db import close_db
+from indexes import ensure_indexes
+from metrics import MetricsMiddleware, registry
+from tracing import TracingMiddleware, span_exporter
+from logging_config import logging_stats
+from services.provisioning_service import start_provisioning_workers, stop_provisioning_workers, provisioning_metrics
+from services.message_service import message_sink
 
 app = FastAPI()
 
@@ -23,16 +34,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metriche per route (durata, status, richieste in corso), esposte su /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Tracing dei turni di chat e delle callback dei tool (attivo solo con TRACE_EXPORT_FILE)
+app.add_middleware(TracingMiddleware)
+
+# Statistiche già raccolte dai vari componenti, lette solo al momento dello scrape
+registry.collector("agent_cache", agent_cache.stats)
+registry.collector("token_cache", token_cache.stats)
+registry.collector("slots_cache", slots_cache.stats)
+registry.collector("credential_cache", credential_cache.stats)
+registry.collector("message_sink", message_sink.stats)
+registry.collector("provisioning", provisioning_metrics)
+registry.collector("trace_exporter", span_exporter.stats)
+registry.collector("logging", logging_stats)
+
 # Routes
 app.include_router(auth_router)
 app.include_router(appointment_routes)
 app.include_router(letta_router)
 app.include_router(frontend_routes)
 app.include_router(mfa_routes)
+app.include_router(metrics_routes)
 
 @app.on_event("startup")
 async def startup_event():
-    register_tools_on_startup()
+    span_exporter.start()
+    await ensure_indexes()
+    message_sink.start()
+    if TOOLS_REGISTER_BACKGROUND:
+        start_tools_registration()
+    else:
+        await register_tools_on_startup()
+    start_provisioning_workers()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_provisioning_workers()
+    # Scrive i messaggi ancora in coda prima di chiudere la connessione al db
+    await message_sink.stop()
+    await close_db()
+    span_exporter.stop()
 
 @app.get("/")
 def home():
@@ -0,0 +1,231 @@
+import inspect
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# Metriche del backend in formato Prometheus, esposte su /metrics.
+# Le metriche vengono aggiornate dall'event loop (middleware, listener di pymongo, chiamate a Letta):
+# ogni osservazione costa qualche lookup su dict, senza lock né allocazioni per richiesta.
+
+# Bucket in secondi: da richieste servite dalla cache (ms) a turni di chat con l'agente (decine di secondi)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Se impostato, /metrics richiede l'header Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self._values.items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) - amount
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label_values -> [conteggi per bucket (non cumulativi, l'ultimo è +Inf), somma, numero di osservazioni]
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                yield f"{self.name}_bucket", _format_labels(self.labels, label_values, f'le="{le}"'), cumulative
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    """
+    Metriche registrate più i "collector": funzioni (anche async) lette solo al momento dello scrape,
+    che restituiscono un dict di valori esposti come gauge <prefisso>_<chiave> (es. le stats delle cache).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def collector(self, prefix: str, func):
+        self._collectors.append((prefix, func))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+
+        for prefix, func in self._collectors:
+            try:
+                values = func()
+                if inspect.isawaitable(values):
+                    values = await values
+            except Exception as e:
+                lines.append(f"# collector {prefix} fallito: {_escape(e)}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# HTTP
+http_requests = registry.counter("http_requests_total", "Richieste HTTP per route, metodo e status", ("route", "method", "status"))
+http_request_duration = registry.histogram("http_request_duration_seconds", "Durata delle richieste HTTP per route", ("route", "method"))
+http_in_flight = registry.gauge("http_requests_in_flight", "Richieste HTTP in corso per gruppo di route", ("group",))
+# Callback dei tool Letta verso /tool, per route e status
+tool_callbacks = registry.counter("tool_callbacks_total", "Chiamate dei tool Letta verso il backend", ("route", "status"))
+
+# MongoDB (command monitoring di pymongo)
+mongo_command_duration = registry.histogram("mongo_command_duration_seconds", "Durata dei comandi MongoDB", ("command",))
+mongo_command_failures = registry.counter("mongo_command_failures_total", "Comandi MongoDB falliti", ("command",))
+
+# Letta
+letta_call_duration = registry.histogram("letta_call_duration_seconds", "Durata delle chiamate a Letta", ("operation",))
+letta_slot_wait = registry.histogram("letta_slot_wait_seconds", "Attesa di uno slot di concorrenza verso Letta")
+letta_tool_calls = registry.counter("letta_tool_calls_total", "Tool eseguiti dagli agenti durante i turni di chat", ("tool", "status"))
+
+# bcrypt
+password_hash_duration = registry.histogram("password_hash_duration_seconds", "Durata di hash e verifica bcrypt", ("operation",))
+password_hash_wait = registry.histogram("password_hash_wait_seconds", "Attesa di un posto nel pool bcrypt")
+
+
+# Gruppi per il gauge delle richieste in corso: il prefisso del path, limitato ai router dell'app
+ROUTE_GROUPS = {"auth", "tool", "letta", "frontend", "mfa", "metrics"}
+
+def _route_group(path: str) -> str:
+    group = path.split("/", 2)[1]
+    return group if group in ROUTE_GROUPS else "other"
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: durata, status e richieste in corso per route. La route è il template registrato
+    (es. /tool/appointments/{user_id}) letto dallo scope dopo il routing, così le label restano poche.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        group = _route_group(scope["path"])
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        http_in_flight.inc(group)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec(group)
+
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_request_duration.observe(elapsed, route_path, method)
+            http_requests.inc(route_path, method, status[0])
+            if group == "tool":
+                tool_callbacks.inc(route_path, status[0])
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Durata di ogni comando MongoDB, per nome del comando (find, insert, update, ...).
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_duration.observe(event.duration_micros / 1_000_000, event.command_name)
+
+    def failed(self, event):
+        mongo_command_duration.observe(event.duration_micros / 1_000_000, event.command_name)
+        mongo_command_failures.inc(event.command_name)
+
+
+mongo_listener = MongoCommandListener()
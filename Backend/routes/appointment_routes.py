@@ -1,11 +1,74 @@
-from datetime import datetime
-from fastapi import APIRouter, Body, HTTPException, Header, Depends
+from datetime import date, datetime
+from fastapi import APIRouter, Body, HTTPException, Header, Depends, Query, Request, Response
+from typing import Optional
+import hashlib
+import json
 import os
-from db import users, appointments
+from db import client as mongo_client, users, appointments, MONGO_TRANSACTIONS
 from bson import ObjectId, errors
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConfigurationError, DuplicateKeyError, OperationFailure
+from services.cache import TTLCache
+from logging_config import get_logger
+from services.availability_service import free_slots_on, next_free_slots
+from services.appointment_time import (
+    APPOINTMENT_DURATION_MINUTES, CLINIC_TIMEZONE, AppointmentTimeError,
+    appointment_fields, clinic_now, day_range, normalize_date, normalize_time, to_local
+)
 
 router = APIRouter(prefix="/tool", tags=["Tool"])
 
+logger = get_logger(__name__)
+
+# Cache degli slot occupati per intervallo di date: svuotata ad ogni create/update/delete di questo processo,
+# il TTL limita quanto può restare indietro rispetto alle modifiche fatte da altri worker
+SLOTS_CACHE_TTL = float(os.getenv("SLOTS_CACHE_TTL", "30"))
+slots_cache = TTLCache(maxsize=256, ttl=SLOTS_CACHE_TTL)
+
+# Numero massimo di operazioni in una chiamata a /appointments/batch
+APPOINTMENT_BATCH_MAX = int(os.getenv("APPOINTMENT_BATCH_MAX", "20"))
+
+def invalidate_slots_cache():
+    slots_cache.clear()
+
+def parse_date_param(value: Optional[str], name: str) -> Optional[date]:
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} deve essere nel formato YYYY-MM-DD")
+
+def serialize_appointment(appt: dict) -> dict:
+    return {
+        "appointment_id": str(appt["_id"]),
+        "user_id": appt["user_id"],
+        "email": appt["email"],
+        "date": appt["date"],
+        "time": appt["time"],
+        "start": appt["start"].isoformat() if appt.get("start") else None,
+        "duration_minutes": appt.get("duration_minutes"),
+        "created_at": appt["created_at"].isoformat() if "created_at" in appt else None
+    }
+
+def update_pipeline(update_data: dict) -> list:
+    # Pipeline di aggiornamento: start viene ricalcolato da data e ora risultanti, anche quando ne cambia solo una.
+    # Se la data o l'ora di un documento non ancora migrato non sono interpretabili start resta quello esistente:
+    # con null il documento uscirebbe dall'indice unique parziale e dagli slot occupati
+    return [
+        {"$set": update_data},
+        {"$set": {
+            "start": {"$dateFromString": {
+                "dateString": {"$concat": ["$date", "T", "$time"]},
+                "format": "%Y-%m-%dT%H:%M",
+                "timezone": CLINIC_TIMEZONE,
+                "onError": "$start",
+                "onNull": "$start"
+            }},
+            "duration_minutes": {"$ifNull": ["$duration_minutes", APPOINTMENT_DURATION_MINUTES]}
+        }}
+    ]
+
 def verify_letta_token(x_letta_token: str = Header(...)):
     """
     Controlla che l'header X-Letta-Token sia corretto.
@@ -16,7 +79,7 @@ def verify_letta_token(x_letta_token: str = Header(...)):
 
 # Crea un appuntamento 
 @router.post("/appointments", dependencies=[Depends(verify_letta_token)])
-def create_appointment(data: dict = Body(...)):
+async def create_appointment(data: dict = Body(...)):
 
     user_id = data.get("user_id")
     email = data.get("email")
@@ -25,12 +88,17 @@ def create_appointment(data: dict = Body(...)):
 
     if not user_id or not email or not date or not time:
         raise HTTPException(status_code=400, detail="user_id, email, date e time sono obbligatori")
+    try:
+        # Data e ora vengono normalizzate (es. "2025-3-1" -> "2025-03-01") e l'inizio salvato in UTC
+        fields = appointment_fields(date, time)
+    except AppointmentTimeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         oid = ObjectId(user_id)
     except errors.InvalidId:
         raise HTTPException(status_code=400, detail="user_id non valido")
 
-    user = users.find_one({"_id": oid, "email": email})
+    user = await users.find_one({"_id": oid, "email": email})
 
     if not user:
         raise HTTPException(
@@ -38,26 +106,23 @@ def create_appointment(data: dict = Body(...)):
             detail="User ID ed email non corrispondono ad alcun utente"
         )
     
-    existing = appointments.find_one({
-        "date": date,
-        "time": time
-    })
-
-    if existing:
-        raise HTTPException(
-            status_code=409,
-            detail=f"Esiste già un appuntamento il {date} alle {time}"
-        )
-
     appointment = {
         "user_id": user_id,
         "email": email,
-        "date": date,
-        "time": time,
+        **fields,
         "created_at": datetime.utcnow()
     }
 
-    appointments.insert_one(appointment)
+    # L'indice unique su start rende la prenotazione atomica: niente controllo preventivo dello slot
+    try:
+        await appointments.insert_one(appointment)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Esiste già un appuntamento il {fields['date']} alle {fields['time']}"
+        )
+
+    invalidate_slots_cache()
 
     return {
         "message": "Appuntamento salvato correttamente"
@@ -65,39 +130,94 @@ def create_appointment(data: dict = Body(...)):
 
 # Restituisce tutti gli appuntamenti
 @router.get("/appointments", dependencies=[Depends(verify_letta_token)])
-def get_appointments():
+async def get_appointments():
     result = []
 
-    for appt in appointments.find():
+    async for appt in appointments.find():
         appt.pop("_id", None)  # Rimuove l'ObjectId
         appt["created_at"] = appt["created_at"].isoformat() if "created_at" in appt else None       #devo fare così perchè sto modificando direttamente il file di mongo BSON
         result.append(appt)
 
     return {"appointments": result}
 
-# Restituisce tutti gli appuntamenti di un utente
+# Restituisce solo le coppie (data, ora) occupate, eventualmente limitate a un intervallo di date.
+# Le risposte hanno un ETag: se il chiamante invia If-None-Match e gli slot non sono cambiati riceve 304 senza corpo.
+@router.get("/appointments/slots", dependencies=[Depends(verify_letta_token)])
+async def get_occupied_slots(
+    request: Request,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to")
+):
+    date_from = parse_date_param(date_from, "from")
+    date_to = parse_date_param(date_to, "to")
+
+    cache_key = (date_from, date_to)
+    cached = slots_cache.get(cache_key)
+    if cached is None:
+        # Scansione per intervallo sull'indice start, con proiezione sul solo campo indicizzato:
+        # nessun dato utente esce dal db e data e ora locali vengono ricavate dall'inizio in UTC
+        cursor = appointments.find(day_range(date_from, date_to), {"_id": 0, "start": 1}).sort("start", 1)
+        slots = []
+        async for appt in cursor:
+            local = to_local(appt["start"])
+            slots.append({"date": local.strftime("%Y-%m-%d"), "time": local.strftime("%H:%M")})
+
+        body = json.dumps({"slots": slots})
+        etag = '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+        cached = (etag, body)
+        slots_cache.set(cache_key, cached)
+
+    etag, body = cached
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+# Restituisce gli orari liberi di un giorno secondo il calendario dell'ambulatorio
+@router.get("/availability", dependencies=[Depends(verify_letta_token)])
+async def get_free_slots_on(day: str = Query(..., alias="date")):
+    day = parse_date_param(day, "date")
+    return {"date": day.isoformat(), "free_slots": await free_slots_on(day)}
+
+# Restituisce i primi `count` slot liberi dopo l'istante indicato (di default adesso)
+@router.get("/availability/next", dependencies=[Depends(verify_letta_token)])
+async def get_next_free_slots(
+    after: Optional[str] = None,
+    count: int = Query(5, ge=1, le=50)
+):
+    if after:
+        try:
+            after_dt = datetime.strptime(after, "%Y-%m-%d %H:%M")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="after deve essere nel formato YYYY-MM-DD HH:MM")
+    else:
+        # Gli slot del calendario sono in ora locale dell'ambulatorio
+        after_dt = clinic_now()
+
+    return {"free_slots": await next_free_slots(after_dt, count)}
+
+# Restituisce gli appuntamenti di un utente in ordine cronologico, eventualmente limitati a un intervallo di date
 @router.get("/appointments/{user_id}", dependencies=[Depends(verify_letta_token)])
-def get_user_appointments(user_id: str):
+async def get_user_appointments(
+    user_id: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to")
+):
+    date_from = parse_date_param(date_from, "from")
+    date_to = parse_date_param(date_to, "to")
 
-    appts = appointments.find({"user_id": user_id}).sort("created_at", 1)
+    # Scansione per intervallo sull'indice (user_id, start)
+    query = {"user_id": user_id}
+    if date_from or date_to:
+        query.update(day_range(date_from, date_to))
 
-    result = []
-    for appt in appts:
-        appt_dict = {
-            "appointment_id": str(appt["_id"]), 
-            "user_id": appt["user_id"],
-            "email": appt["email"],
-            "date": appt["date"],
-            "time": appt["time"],
-            "created_at": appt["created_at"].isoformat() if "created_at" in appt else None
-        }
-        result.append(appt_dict)
+    appts = appointments.find(query).sort("start", 1)
 
-    return {"appointments": result}
+    return {"appointments": [serialize_appointment(appt) async for appt in appts]}
 
 # Cancella un appuntamento
 @router.delete("/appointments/{appointment_id}", dependencies=[Depends(verify_letta_token)])
-def delete_appointment(appointment_id: str, data: dict = Body(...)):
+async def delete_appointment(appointment_id: str, data: dict = Body(...)):
     user_id = data.get("user_id")
 
     try:
@@ -105,7 +225,7 @@ def delete_appointment(appointment_id: str, data: dict = Body(...)):
     except errors.InvalidId:
         raise HTTPException(status_code=400, detail="appointment_id non valido")
 
-    appt = appointments.find_one({"_id": oid})
+    appt = await appointments.find_one({"_id": oid})
 
     if not appt:
         raise HTTPException(status_code=404, detail="Appuntamento non trovato")
@@ -116,7 +236,8 @@ def delete_appointment(appointment_id: str, data: dict = Body(...)):
             detail="Non puoi cancellare un appuntamento che non ti appartiene"
         )
 
-    appointments.delete_one({"_id": oid})
+    await appointments.delete_one({"_id": oid})
+    invalidate_slots_cache()
 
     return {
         "status": "success",
@@ -126,7 +247,7 @@ def delete_appointment(appointment_id: str, data: dict = Body(...)):
 
 # Modifica un appuntamento
 @router.put("/appointments/{appointment_id}", dependencies=[Depends(verify_letta_token)])
-def update_appointment(appointment_id: str, data: dict = Body(...)):
+async def update_appointment(appointment_id: str, data: dict = Body(...)):
     user_id = data.get("user_id")
     date = data.get("date")
     time = data.get("time")
@@ -148,46 +269,179 @@ def update_appointment(appointment_id: str, data: dict = Body(...)):
     except errors.InvalidId:
         raise HTTPException(status_code=400, detail="appointment_id non valido")
 
-    appt = appointments.find_one({"_id": oid})
-    if not appt:
-        raise HTTPException(status_code=404, detail="Appuntamento non trovato")
+    update_data = {}
+    try:
+        if date:
+            update_data["date"] = normalize_date(date)
+        if time:
+            update_data["time"] = normalize_time(time)
+    except AppointmentTimeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    update_data["updated_at"] = datetime.utcnow()
+
+    # Aggiornamento condizionato al proprietario: l'indice unique su start segnala i conflitti di slot
+    try:
+        updated = await appointments.find_one_and_update(
+            {"_id": oid, "user_id": user_id},
+            update_pipeline(update_data),
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=409,
+            detail="Esiste già un appuntamento in questa data e a questo orario"
+        )
+
+    if not updated:
+        # Solo in caso di errore si distingue tra appuntamento inesistente e appuntamento di un altro utente
+        if not await appointments.find_one({"_id": oid}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Appuntamento non trovato")
 
-    if appt.get("user_id") != user_id:
         raise HTTPException(
             status_code=403,
             detail="Non puoi modificare un appuntamento che non ti appartiene"
         )
 
-    # Usa i valori nuovi se forniti, altrimenti quelli esistenti
-    new_date = date if date else appt.get("date")
-    new_time = time if time else appt.get("time")
+    invalidate_slots_cache()
 
-    # Controllo conflitto: stesso utente, stessa data e stesso orario
-    conflict = appointments.find_one({
-        "date": new_date,
-        "time": new_time,
-        "_id": {"$ne": oid}  # esclude l'appuntamento corrente
-    })
+    return {
+        "status": "success",
+        "message": "Appuntamento aggiornato correttamente",
+        "appointment_id": appointment_id
+    }
 
+def parse_batch_operation(index: int, op: dict, user_id: str, email: str):
+    """
+    Converte un'operazione del batch nella scrittura Mongo corrispondente.
+    Ritorna (scrittura, id appuntamento, id da verificare) oppure solleva 400.
+    """
+    kind = op.get("op") if isinstance(op, dict) else None
+    try:
+        if kind == "create":
+            if not op.get("date") or not op.get("time"):
+                raise HTTPException(status_code=400, detail=f"Operazione {index}: date e time sono obbligatori")
+            oid = ObjectId()
+            return InsertOne({
+                "_id": oid,
+                "user_id": user_id,
+                "email": email,
+                **appointment_fields(op["date"], op["time"]),
+                "created_at": datetime.utcnow()
+            }), oid, None
+
+        if kind in ("update", "delete"):
+            try:
+                oid = ObjectId(op.get("appointment_id"))
+            except (errors.InvalidId, TypeError):
+                raise HTTPException(status_code=400, detail=f"Operazione {index}: appointment_id non valido")
+
+            if kind == "delete":
+                return DeleteOne({"_id": oid, "user_id": user_id}), oid, oid
+
+            update_data = {}
+            if op.get("date"):
+                update_data["date"] = normalize_date(op["date"])
+            if op.get("time"):
+                update_data["time"] = normalize_time(op["time"])
+            if not update_data:
+                raise HTTPException(status_code=400, detail=f"Operazione {index}: serve almeno uno tra date o time")
+            update_data["updated_at"] = datetime.utcnow()
+            return UpdateOne({"_id": oid, "user_id": user_id}, update_pipeline(update_data)), oid, oid
+
+    except AppointmentTimeError as e:
+        raise HTTPException(status_code=400, detail=f"Operazione {index}: {e}")
+
+    raise HTTPException(status_code=400, detail=f"Operazione {index}: op deve essere create, update o delete")
+
+# Esegue più operazioni (create/update/delete) sugli appuntamenti dell'utente con una sola chiamata
+# e restituisce la lista aggiornata, così l'agente non deve rileggerla con un'altra richiesta
+@router.post("/appointments/batch", dependencies=[Depends(verify_letta_token)])
+async def batch_appointments(data: dict = Body(...)):
+    user_id = data.get("user_id")
+    email = data.get("email")
+    operations = data.get("operations")
+
+    if not user_id or not email:
+        raise HTTPException(status_code=400, detail="user_id ed email sono obbligatori")
+    if not isinstance(operations, list) or not operations:
+        raise HTTPException(status_code=400, detail="operations deve essere una lista non vuota")
+    if len(operations) > APPOINTMENT_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Al massimo {APPOINTMENT_BATCH_MAX} operazioni per batch")
+
+    parsed = [parse_batch_operation(i, op, user_id, email) for i, op in enumerate(operations)]
+    writes = [write for write, _, _ in parsed]
+
+    if any(op["op"] == "create" for op in operations):
+        try:
+            oid = ObjectId(user_id)
+        except errors.InvalidId:
+            raise HTTPException(status_code=400, detail="user_id non valido")
+        if not await users.find_one({"_id": oid, "email": email}, {"_id": 1}):
+            raise HTTPException(status_code=401, detail="User ID ed email non corrispondono ad alcun utente")
+
+    # Un'unica lettura per verificare esistenza e proprietario di tutti gli appuntamenti coinvolti
+    to_check = {oid for _, _, oid in parsed if oid is not None}
+    if to_check:
+        owners = {
+            appt["_id"]: appt.get("user_id")
+            async for appt in appointments.find({"_id": {"$in": list(to_check)}}, {"user_id": 1})
+        }
+        for i, (_, _, oid) in enumerate(parsed):
+            if oid is None:
+                continue
+            if oid not in owners:
+                raise HTTPException(status_code=404, detail=f"Operazione {i}: appuntamento non trovato")
+            if owners[oid] != user_id:
+                raise HTTPException(status_code=403, detail=f"Operazione {i}: l'appuntamento non ti appartiene")
+
+    expected_updates = sum(1 for write in writes if isinstance(write, UpdateOne))
+    expected_deletes = sum(1 for write in writes if isinstance(write, DeleteOne))
+
+    async def run_writes(session=None):
+        # bulk_write ordinato: le operazioni vengono applicate nell'ordine dato e ci si ferma al primo errore
+        result = await appointments.bulk_write(writes, ordered=True, session=session)
+        if result.matched_count != expected_updates or result.deleted_count != expected_deletes:
+            # Un appuntamento è stato cancellato o modificato da un'altra richiesta dopo la verifica
+            raise HTTPException(status_code=409, detail="Gli appuntamenti sono cambiati durante l'operazione, riprova")
 
-    if conflict:
+    try:
+        if MONGO_TRANSACTIONS:
+            # Tutte le operazioni in una transazione: o vengono applicate tutte o nessuna
+            async with mongo_client.start_session() as session:
+                await session.with_transaction(run_writes)
+        else:
+            await run_writes()
+    except BulkWriteError as e:
+        error = e.details["writeErrors"][0]
+        applied = "nessuna modifica è stata applicata" if MONGO_TRANSACTIONS else f"le operazioni precedenti alla {error['index']} sono state applicate"
+        if error.get("code") == 11000:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Operazione {error['index']}: esiste già un appuntamento in questa data e a questo orario, {applied}"
+            )
+        raise HTTPException(status_code=500, detail=f"Operazione {error['index']} fallita: {error.get('errmsg')}, {applied}")
+    except (OperationFailure, ConfigurationError) as e:
+        if not MONGO_TRANSACTIONS:
+            raise
+        # Errori della transazione: nessuna modifica è stata applicata
+        if e.has_error_label("TransientTransactionError"):
+            raise HTTPException(status_code=409, detail="Gli appuntamenti sono stati modificati da un'altra richiesta, riprova")
+        logger.error("Transazione sugli appuntamenti non riuscita", extra={"error": str(e)})
         raise HTTPException(
-            status_code=409,
-            detail="Esiste già un appuntamento in questa data e a questo orario"
+            status_code=503,
+            detail="Transazioni non disponibili sul database (serve un replica set, altrimenti MONGO_TRANSACTIONS=false)"
         )
+    finally:
+        invalidate_slots_cache()
 
-    update_data = {}
-    if date:
-        update_data["date"] = date
-    if time:
-        update_data["time"] = time
-
-    update_data["updated_at"] = datetime.utcnow()
-
-    appointments.update_one({"_id": oid}, {"$set": update_data})
+    appts = appointments.find({"user_id": user_id}).sort("start", 1)
 
     return {
         "status": "success",
-        "message": "Appuntamento aggiornato correttamente",
-        "appointment_id": appointment_id
+        "results": [
+            {"op": op["op"], "appointment_id": str(appointment_id)}
+            for op, (_, appointment_id, _) in zip(operations, parsed)
+        ],
+        "appointments": [serialize_appointment(appt) async for appt in appts]
     }
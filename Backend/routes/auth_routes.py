@@ -1,8 +1,10 @@
 import time
 from bson import ObjectId
-from fastapi import APIRouter, Request, HTTPException, Response
+from typing import Optional
+from fastapi import APIRouter, Depends, Request, HTTPException, Response
 from db import users
-from auth import hash_password, verify_password, create_access_token, decode_access_token
+from auth import Principal, get_principal, hash_password, verify_password, create_access_token
+from services.provisioning_service import schedule_agent_provisioning
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
 
@@ -15,11 +17,11 @@ async def register(request: Request):
     if not email or not password:
         raise HTTPException(status_code=400, detail="Email e password richieste")
 
-    existing = users.find_one({"email": email})
+    existing = await users.find_one({"email": email})
     if existing:
         raise HTTPException(status_code=400, detail="Email già registrata")
 
-    hashed = hash_password(password)
+    hashed = await hash_password(password)
 
     new_user = {
         "email": email,
@@ -28,7 +30,11 @@ async def register(request: Request):
         "webauthn_credentials": [],
     }
 
-    users.insert_one(new_user)
+    result = await users.insert_one(new_user)
+
+    # L'agente Letta viene preparato in background, prima del primo messaggio in chat
+    schedule_agent_provisioning(str(result.inserted_id), email)
+
     return {"message": "Registrazione completata"}
 
 
@@ -41,13 +47,24 @@ async def login(request: Request, response: Response):
     if not email or not password:
         raise HTTPException(status_code=400, detail="Email e password richieste")
 
-    db_user = users.find_one({"email": email})
-    if not db_user or not verify_password(password, db_user["password_hash"]):
+    db_user = await users.find_one({"email": email})
+    if not db_user:
+        raise HTTPException(status_code=401, detail="Credenziali errate")
+
+    valid, new_hash = await verify_password(password, db_user["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Credenziali errate")
 
+    # Hash con parametri non più attuali: viene rigenerato ora che la password in chiaro è disponibile
+    if new_hash:
+        await users.update_one({"_id": db_user["_id"]}, {"$set": {"password_hash": new_hash}})
+
+    # Con l'MFA attiva l'agente viene preparato solo dopo la verifica della chiave (mfa_login_complete)
     if db_user.get("mfa_enabled", False):
         return {"mfa_required": True, "user_id": str(db_user["_id"])}
 
+    schedule_agent_provisioning(str(db_user["_id"]), db_user["email"])
+
     token = create_access_token({
         "sub": str(db_user["_id"]),
         "email": db_user["email"]
@@ -75,14 +92,7 @@ async def logout(response: Response):
     return {"message": "Logout effettuato"}
 
 @router.get("/me")
-async def get_me(request: Request):
-    token = request.cookies.get("access_token")
-    if not token:
-        return {"logged_in": False}
-    # verifica token qui (decode JWT)
-    try:
-        payload = decode_access_token(token)  # funzione tua per JWT
-        # print(payload)
-        return {"logged_in": True, "user": payload}    # invio il payload in questo modo in quanto il client non può leggere il token per motivi di sicurezza
-    except:
+async def get_me(principal: Optional[Principal] = Depends(get_principal)):
+    if not principal:
         return {"logged_in": False}
+    return {"logged_in": True, "user": principal.payload}    # invio il payload in questo modo in quanto il client non può leggere il token per motivi di sicurezza
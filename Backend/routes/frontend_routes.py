@@ -1,30 +1,52 @@
+import base64
+import json
 from datetime import datetime
-from fastapi import APIRouter, Body, Cookie
-from auth import get_user_id_from_token
+from typing import Optional
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pymongo import ASCENDING, DESCENDING
+from auth import Principal, get_principal
 from db import appointments, messages
-from bson import ObjectId
+from services.appointment_time import AppointmentTimeError, day_range, parse_date
+from services.message_service import message_doc, message_sink, InvalidMessageError, MessageQueueFullError
+from bson import ObjectId, errors
 
 router = APIRouter(prefix="/frontend", tags=["Frontend"])
 
-# Restituisce tutti gli appunatmenti di un utente
+# Restituisce gli appunatmenti di un utente in ordine cronologico, eventualmente limitati a un intervallo di date
 @router.get("/my-appointments")
-def my_appointments(access_token: str = Cookie(None)):
-    if not access_token:
-        return {"error": "Token mancante"}
-    
-    user_id = get_user_id_from_token(access_token)
+async def my_appointments(
+    principal: Optional[Principal] = Depends(get_principal),
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to")
+):
+    if not principal:
+        return {"error": "Token mancante o non valido"}
+
+    user_id = principal.user_id
 
-    if not user_id:
-        return {"error": "Token non valido"}
+    query = {"user_id": user_id}
+    if date_from or date_to:
+        try:
+            query.update(day_range(
+                parse_date(date_from) if date_from else None,
+                parse_date(date_to) if date_to else None
+            ))
+        except AppointmentTimeError as e:
+            return {"error": str(e)}
 
     try:
-        appts_cursor = appointments.find({"user_id": user_id}).sort("created_at", 1)
+        # Scansione per intervallo sull'indice (user_id, start)
+        appts_cursor = appointments.find(query, {"date": 1, "time": 1, "start": 1, "duration_minutes": 1}).sort("start", 1)
         appointments_list = []
-        for appt in appts_cursor:
+        async for appt in appts_cursor:
             appointments_list.append({
                 "appointment_id": str(appt["_id"]),
                 "date": appt.get("date"),
-                "time": appt.get("time")
+                "time": appt.get("time"),
+                "start": appt["start"].isoformat() if appt.get("start") else None,
+                "duration_minutes": appt.get("duration_minutes")
             })
         return {"appointments": appointments_list}
 
@@ -33,57 +55,124 @@ def my_appointments(access_token: str = Cookie(None)):
 
 # Salva un messaggio nel db
 @router.post("/messages")
-def save_message(
+async def save_message(
     message: dict = Body(...),
-    access_token: str = Cookie(None)
+    principal: Optional[Principal] = Depends(get_principal)
 ):
-    if not access_token:
-        return {"error": "Token mancante"}
+    if not principal:
+        return {"error": "Token mancante o non valido"}
 
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        return {"error": "Token non valido"}
+    user_id = principal.user_id
 
     try:
-        doc = {
-            "user_id": user_id,
-            "role": message.get("role"),
-            "content": message.get("content"),
-            "created_at": datetime.utcnow()
-        }
+        doc = message_doc(user_id, message.get("role"), message.get("content"))
 
-        messages.insert_one(doc)
+        # Il messaggio viene accodato e scritto a blocchi dal task in background
+        await message_sink.put(doc)
 
         return {"status": "ok"}
 
+    except InvalidMessageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except MessageQueueFullError:
+        raise HTTPException(status_code=503, detail="Troppi messaggi in attesa di salvataggio, riprova tra poco")
     except Exception as e:
         return {"error": "Errore nel salvataggio messaggio"}
 
-# Ottiene lo storico dei messaggi di un utente
-@router.get("/messages")
-def get_messages(access_token: str = Cookie(None)):
-    if not access_token:
-        return {"error": "Token mancante"}
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
 
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        return {"error": "Token non valido"}
+# Campi restituiti al frontend per ogni messaggio
+MESSAGE_PROJECTION = {"role": 1, "content": 1, "created_at": 1}
 
-    try:
-        cursor = messages.find(
-            {"user_id": user_id}
-        ).sort("created_at", 1)
-
-        messages_list = []
-        for msg in cursor:
-            messages_list.append({
-                "message_id": str(msg["_id"]),
-                "role": msg.get("role"),
-                "content": msg.get("content"),
-                "created_at": msg.get("created_at")
-            })
+def encode_cursor(msg: dict) -> str:
+    # Il cursore identifica in modo univoco la posizione di un messaggio nell'ordinamento (created_at, _id)
+    raw = f"{msg['created_at'].isoformat()}|{msg['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-        return {"messages": messages_list}
+def decode_cursor(cursor: str):
+    try:
+        created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), ObjectId(message_id)
+    except (ValueError, errors.InvalidId):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+
+def serialize_message(msg: dict) -> dict:
+    return {
+        "message_id": str(msg["_id"]),
+        "role": msg.get("role"),
+        "content": msg.get("content"),
+        "created_at": msg.get("created_at")
+    }
+
+# Ottiene lo storico dei messaggi di un utente, a pagine di `limit` messaggi (i più recenti se non si indica un cursore)
+@router.get("/messages")
+async def get_messages(
+    principal: Optional[Principal] = Depends(get_principal),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    if not principal:
+        return {"error": "Token mancante o non valido"}
+
+    user_id = principal.user_id
+
+    # Paginazione a chiave (created_at, _id): ogni pagina è un range scan sull'indice, senza skip
+    query = {"user_id": user_id}
+    direction = DESCENDING
+    if before:
+        created_at, message_id = decode_cursor(before)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": message_id}}
+        ]
+    elif after:
+        created_at, message_id = decode_cursor(after)
+        query["$or"] = [
+            {"created_at": {"$gt": created_at}},
+            {"created_at": created_at, "_id": {"$gt": message_id}}
+        ]
+        direction = ASCENDING
 
+    try:
+        cursor = messages.find(query, MESSAGE_PROJECTION).sort([("created_at", direction), ("_id", direction)]).limit(limit + 1)
+        page = await cursor.to_list(length=limit + 1)
     except Exception:
-        return {"error": "Errore nel recupero messaggi"}
\ No newline at end of file
+        return {"error": "Errore nel recupero messaggi"}
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    if direction == DESCENDING:
+        page.reverse()
+
+    return {
+        "messages": [serialize_message(msg) for msg in page],
+        "has_more": has_more,
+        # Cursori per caricare i messaggi più vecchi (before) o più recenti (after) della pagina
+        "before": encode_cursor(page[0]) if page else None,
+        "after": encode_cursor(page[-1]) if page else None
+    }
+
+# Esporta l'intero storico dei messaggi di un utente come array JSON in streaming, senza caricarlo in memoria
+@router.get("/messages/export")
+async def export_messages(principal: Optional[Principal] = Depends(get_principal)):
+    if not principal:
+        return {"error": "Token mancante o non valido"}
+
+    user_id = principal.user_id
+
+    async def rows():
+        cursor = messages.find({"user_id": user_id}, MESSAGE_PROJECTION).sort([("created_at", ASCENDING), ("_id", ASCENDING)]).batch_size(500)
+        yield "["
+        first = True
+        async for msg in cursor:
+            yield ("" if first else ",") + json.dumps(jsonable_encoder(serialize_message(msg)), ensure_ascii=False)
+            first = False
+        yield "]"
+
+    return StreamingResponse(
+        rows(),
+        media_type="application/json",
+        headers={"Content-Disposition": 'attachment; filename="messages.json"'}
+    )
@@ -1,41 +1,133 @@
 # Backend/routers/letta_router.py
-from fastapi import APIRouter, Cookie, Body
-from services.agent_service import handle_appointment_message
-from auth import get_user_id_from_token, get_email_from_token
+import asyncio
+import json
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from services.agent_service import handle_appointment_message, stream_appointment_message, AgentBusyError
+from services.message_service import MESSAGE_MAX_CHARS, save_turn
+from auth import Principal, get_principal
+from tracing import chat_turn
+from logging_config import get_logger
 
 router = APIRouter(prefix="/letta", tags=["Letta"])
 
+logger = get_logger(__name__)
+
+# Ogni quanto controllare se il browser ha chiuso la connessione durante l'attesa dell'agente
+DISCONNECT_POLL_INTERVAL = 1.0
+
+async def run_until_disconnected(request: Request, coro):
+    """
+    Esegue la coroutine annullandola se il client chiude la connessione prima della risposta.
+    Restituisce None se la richiesta è stata abbandonata.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                return None
+    finally:
+        if not task.done():
+            task.cancel()
+
 # Chimata api che riceve il messaggio dell'utente per poi fornire la risposta dell'agente
 @router.post("/ask")
-def appointment(
+async def appointment(
+    request: Request,
+    background_tasks: BackgroundTasks,
     data: dict = Body(...),
-    access_token: str = Cookie(None)
+    principal: Optional[Principal] = Depends(get_principal)
 ):
-    print("🔵 ROUTER → CHIAMATO")
-    print("🔵 DATA RICEVUTO:", data)
-    print("🔵 ACCESS TOKEN:", access_token)
+    if not principal or not principal.email:
+        logger.info("Richiesta di chat senza token valido")
+        return {"error": "Token mancante o non valido"}
+
+    user_id = principal.user_id
+    email = principal.email
+
+    message = data.get("message")
+    if not message:
+        logger.info("Richiesta di chat senza campo 'message'", extra={"user_id": user_id})
+        return {"error": "Serve il campo 'message'"}
+    if not isinstance(message, str) or len(message) > MESSAGE_MAX_CHARS:
+        return {"error": f"Il messaggio deve essere un testo di al massimo {MESSAGE_MAX_CHARS} caratteri"}
+
+    received_at = datetime.utcnow()
+
+    # Il testo dei messaggi non viene scritto nei log (dati sanitari): solo la lunghezza
+    logger.debug("Messaggio di chat ricevuto", extra={"user_id": user_id, "message_chars": len(message)})
+    # Il turno apre la traccia: chiamate a Letta, callback dei tool e query su Mongo ne diventano figlie
+    with chat_turn(user_id, stream=False):
+        try:
+            reply = await run_until_disconnected(request, handle_appointment_message(user_id, email, message))
+        except AgentBusyError:
+            raise HTTPException(status_code=503, detail="Troppe richieste in corso, riprova tra poco")
 
-    if not access_token:
-        print("🔴 Manca token")
-        return {"error": "Token mancante"}
+    # Entrambi i messaggi del turno vengono salvati dopo l'invio della risposta
+    background_tasks.add_task(save_turn, user_id, message, reply, received_at)
 
-    user_id = get_user_id_from_token(access_token)
-    email = get_email_from_token(access_token)
-    print("🔵 USER ID:", user_id)
-    print("🔵 EMAIL:", email)
+    if reply is None:
+        logger.info("Client disconnesso, richiesta annullata", extra={"user_id": user_id})
+        return {"error": "Richiesta annullata"}
 
-    if not user_id or not email:
-        print("🔴 Token non valido")
-        return {"error": "Token non valido"}
+    logger.debug("Risposta dell'agente inviata", extra={"user_id": user_id, "reply_chars": len(reply)})
+
+    return {"response": reply}
+
+def sse_event(event: dict) -> str:
+    # Formato Server-Sent Events: nome dell'evento e payload JSON su una riga
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# Variante in streaming di /ask: inoltra al browser gli eventi dell'agente via Server-Sent Events
+@router.post("/ask/stream")
+async def appointment_stream(
+    data: dict = Body(...),
+    principal: Optional[Principal] = Depends(get_principal)
+):
+    if not principal or not principal.email:
+        return {"error": "Token mancante o non valido"}
+
+    user_id = principal.user_id
+    email = principal.email
 
     message = data.get("message")
-    print("🔵 MESSAGE:", message)
     if not message:
-        print("🔴 Nessun campo 'message'")
         return {"error": "Serve il campo 'message'"}
+    if not isinstance(message, str) or len(message) > MESSAGE_MAX_CHARS:
+        return {"error": f"Il messaggio deve essere un testo di al massimo {MESSAGE_MAX_CHARS} caratteri"}
 
-    print("🟡 Chiamo handle_appointment_message...")
-    reply = handle_appointment_message(user_id, email, message)
-    print("🟢 RISPOSTA AGENTE:", reply)
+    received_at = datetime.utcnow()
+    reply_parts = []
 
-    return {"response": reply}
+    async def events():
+        # Se il browser si disconnette Starlette annulla il generatore, e con lui lo stream verso Letta
+        with chat_turn(user_id, stream=True):
+            try:
+                async for event in stream_appointment_message(user_id, email, message):
+                    if event["type"] in ("token", "error"):
+                        reply_parts.append(event["content"])
+                    yield sse_event(event)
+            except AgentBusyError:
+                yield sse_event({"type": "error", "content": "Troppe richieste in corso, riprova tra poco"})
+            except Exception as e:
+                # Errori di Letta, timeout o connessione interrotta: il browser riceve comunque un evento finale
+                logger.exception("Errore nello stream dell'agente", extra={"user_id": user_id, "error": type(e).__name__})
+                yield sse_event({"type": "error", "content": "Errore nella risposta dell'agente, riprova tra poco"})
+
+    async def persist_turn():
+        await save_turn(user_id, message, "".join(reply_parts), received_at)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Il turno viene salvato a stream concluso, con la risposta completa
+        background=BackgroundTask(persist_turn)
+    )
@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from metrics import METRICS_TOKEN, registry
+
+router = APIRouter(tags=["Metrics"])
+
+# Metriche in formato Prometheus (text exposition format 0.0.4)
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Token per le metriche non valido")
+
+    return PlainTextResponse(await registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
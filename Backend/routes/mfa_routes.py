@@ -1,56 +1,63 @@
 from bson import ObjectId
-from fastapi import APIRouter, Cookie, HTTPException, Response, Request
+from pymongo.errors import DuplicateKeyError
+from fastapi import APIRouter, Cookie, Depends, HTTPException, Response, Request
+from typing import Optional
 from db import users
-from auth import get_user_id_from_token, create_access_token
+from auth import Principal, create_access_token, require_principal
 from fido import fido2_server
 from fido2 import cbor
-import cbor2
 import base64
-from fido2.server import to_descriptor
-from fido2.webauthn import AttestedCredentialData
-from fido2.webauthn import PublicKeyCredentialDescriptor
-from fido2.cose import CoseKey
+from services.credential_service import (
+    credential_descriptor, credential_exists, credential_record, find_credential_owner,
+    remember_credential, websafe_b64decode, websafe_b64encode
+)
+from services.challenge_store import MFA_CHALLENGE_TTL, cancel_ceremony, finish_ceremony, start_ceremony
+from services.provisioning_service import schedule_agent_provisioning
+from logging_config import get_logger
 
 router = APIRouter(prefix="/mfa", tags=["Mfa"])
 
+logger = get_logger(__name__)
 
-def websafe_b64decode(data: str) -> bytes:
-    padding = '=' * ((4 - len(data) % 4) % 4)
-    return base64.urlsafe_b64decode(data + padding)
+# Cookie con l'id opaco della cerimonia WebAuthn in corso: la sfida resta lato server nel challenge store
+CEREMONY_COOKIE = "mfa_ceremony"
 
-def websafe_b64encode(data: bytes) -> str:
-    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+def set_ceremony_cookie(response: Response, ceremony_id: str):
+    response.set_cookie(
+        key=CEREMONY_COOKIE,
+        value=ceremony_id,
+        httponly=True,
+        secure=True,
+        samesite="none",
+        max_age=MFA_CHALLENGE_TTL,
+        path="/mfa"
+    )
+
+def clear_ceremony_cookie(response: Response):
+    response.delete_cookie(key=CEREMONY_COOKIE, path="/mfa", secure=True, httponly=True, samesite="none")
 
 @router.post("/register/cancel")
-async def register_cancel(access_token: str = Cookie(None)):
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Utente non autenticato")
-    users.update_one({"_id": ObjectId(user_id)}, {"$unset": {"mfa_challenge": ""}})
+async def register_cancel(
+    response: Response,
+    principal: Principal = Depends(require_principal),
+    mfa_ceremony: Optional[str] = Cookie(None)
+):
+    await cancel_ceremony(mfa_ceremony)
+    clear_ceremony_cookie(response)
     return {"status": "cancelled"}
 
 # Il server genera una sfida crittografica per la registrazione di una nuova chiave MFA e la invia al browser. 
 @router.post("/register/begin")
-async def register_begin(access_token: str = Cookie(None)):
+async def register_begin(principal: Principal = Depends(require_principal)):
 
-    print("Token ricevuto:", access_token)
-    
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Utente non autenticato")
+    user_id = principal.user_id
 
-    user = users.find_one({"_id": ObjectId(user_id)})
+    user = await users.find_one({"_id": ObjectId(user_id)}, {"email": 1, "webauthn_credentials.credential_id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
-    devices = []
-    for d in user.get("webauthn_credentials", []):
-        cred = AttestedCredentialData.create(
-            aaguid=b"\x00" * 16,
-            credential_id=websafe_b64decode(d["credential_id"]),
-            public_key=CoseKey.parse(cbor2.loads(base64.urlsafe_b64decode(d["public_key"] + "==")))
-        )
-        devices.append(to_descriptor(cred))
+    # Chiavi già registrate, da escludere: serve solo il credential_id
+    devices = [credential_descriptor(d) for d in user.get("webauthn_credentials", [])]
 
     options, state = fido2_server.register_begin(
         {
@@ -62,52 +69,60 @@ async def register_begin(access_token: str = Cookie(None)):
         user_verification= "preferred"
     )
 
-    users.update_one(
-        {"_id": user["_id"]},
-        {"$set": {"mfa_challenge": state}}
-    )
+    ceremony_id = await start_ceremony(user_id, "register", state)
 
-    return Response(
+    response = Response(
         content=cbor.encode(options),
         media_type="application/cbor"
     )
+    set_ceremony_cookie(response, ceremony_id)
+    return response
 # Il server riceve la chiave pubblica e la firma associata, ne verifica la validità e registra nel database la chiave pubblica insieme al relativo identificativo, associandoli all’utente.
 @router.post("/register/complete")
-async def register_complete(request: Request, access_token: str = Cookie(None)):
+async def register_complete(
+    request: Request,
+    response: Response,
+    principal: Principal = Depends(require_principal),
+    mfa_ceremony: Optional[str] = Cookie(None)
+):
 
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        raise HTTPException(status_code=401)
-
-    user = users.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404)
+    user_id = principal.user_id
 
     credential = await request.json()
 
-    state = user.get("mfa_challenge")
-    if not state:
+    # La sfida è monouso: viene consumata anche se la verifica fallisce
+    challenge = await finish_ceremony(mfa_ceremony, "register")
+    clear_ceremony_cookie(response)
+    if not challenge or challenge["user_id"] != user_id:
         raise HTTPException(status_code=400, detail="Nessuna sfida MFA in corso")
 
-    auth_data = fido2_server.register_complete(state, credential)
+    auth_data = fido2_server.register_complete(challenge["state"], credential)
 
     cred = auth_data.credential_data
-    print("cred: ",cred)
+    device_record = credential_record(cred)
 
-    device_record = {
-        "credential_id": base64.urlsafe_b64encode(cred.credential_id).rstrip(b"=").decode(),
-        "public_key": base64.urlsafe_b64encode(cbor2.dumps(cred.public_key)).decode(),
-    }
+    # Il credential_id è scelto dall'autenticatore: non può riusare quello di una chiave già registrata, di nessun utente
+    if await credential_exists(device_record["credential_id"]):
+        raise HTTPException(status_code=409, detail="Chiave MFA già registrata")
 
-    users.update_one(
-        {"_id": user["_id"]},
-        {
-            "$push": {"webauthn_credentials": device_record},
-            "$unset": {"mfa_challenge": ""},
-            "$set": {"mfa_enabled": True},
-        }
-    )
+    try:
+        result = await users.update_one(
+            {"_id": ObjectId(user_id)},
+            {
+                "$push": {"webauthn_credentials": device_record},
+                "$set": {"mfa_enabled": True},
+            }
+        )
+    except DuplicateKeyError:
+        # Registrazione concorrente dello stesso credential_id
+        raise HTTPException(status_code=409, detail="Chiave MFA già registrata")
+    if not result.matched_count:
+        raise HTTPException(status_code=404)
 
+    # La credenziale è già decodificata: entra subito in cache per il prossimo login
+    remember_credential(user_id, device_record, cred)
+
+    logger.info("Chiave MFA registrata", extra={"user_id": user_id, "credential_id": device_record["credential_id"]})
     return {"status": "ok"}
 # Dopo la verifica di username e password, il server genera una nuova sfida temporanea e la invia al browser.
 @router.post("/login/begin")
@@ -117,7 +132,7 @@ async def login_begin(request: Request):
     """
     data = await request.json()
     user_id = data.get("user_id")
-    user = users.find_one({"_id": ObjectId(user_id)})
+    user = await users.find_one({"_id": ObjectId(user_id)}, {"webauthn_credentials.credential_id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
@@ -133,54 +148,44 @@ async def login_begin(request: Request):
 
     options, state = fido2_server.authenticate_begin(devices)
 
-    users.update_one({"_id": user["_id"]}, {"$set": {"mfa_challenge": state}})
+    ceremony_id = await start_ceremony(str(user["_id"]), "login", state)
 
-    return Response(content=cbor.encode(options), media_type="application/cbor")
+    response = Response(content=cbor.encode(options), media_type="application/cbor")
+    set_ceremony_cookie(response, ceremony_id)
+    return response
 
 # Il browser firma la sfida utilizzando la chiave privata e invia la risposta al server, che ne verifica la correttezza.
 @router.post("/login/complete")
-async def mfa_login_complete(request: Request, response: Response):
+async def mfa_login_complete(request: Request, response: Response, mfa_ceremony: Optional[str] = Cookie(None)):
     credential = await request.json()
 
+    # La sfida è monouso: viene consumata anche se la verifica fallisce
+    challenge = await finish_ceremony(mfa_ceremony, "login")
+    clear_ceremony_cookie(response)
+    if not challenge:
+        raise HTTPException(status_code=400, detail="Nessuna sfida MFA in corso")
+
     # Estrae credential_id dal payload WebAuthn
     credential_id = websafe_b64encode(
         base64.urlsafe_b64decode(credential["id"] + "==")
     )
 
-    # Trova l'utente che POSSIEDE quella chiave
-    user = users.find_one({
-        "webauthn_credentials.credential_id": credential_id,
-        "mfa_challenge": {"$exists": True}
-    })
+    # Trova l'utente che POSSIEDE quella chiave, insieme alla sola credenziale usata (già decodificata se in cache)
+    user, registered_credential = await find_credential_owner(credential_id)
 
-    if not user:
+    # La chiave deve appartenere all'utente che ha avviato la cerimonia
+    if not user or str(user["_id"]) != challenge["user_id"]:
         raise HTTPException(status_code=400, detail="Credenziale o challenge non valida")
 
-    registered_credentials = [
-        AttestedCredentialData.create(
-            aaguid=b"\x00" * 16,
-            credential_id=websafe_b64decode(d["credential_id"]),
-            public_key=CoseKey.parse(cbor2.loads(base64.urlsafe_b64decode(d["public_key"] + "=="))) 
-            )
-        for d in user.get("webauthn_credentials", [])
-    ]
-
-
-    state = user.get("mfa_challenge")
-    if not state:
-        raise HTTPException(status_code=400, detail="Nessuna sfida MFA in corso")
-
     try:
         fido2_server.authenticate_complete(
-            state,
-            registered_credentials,
+            challenge["state"],
+            [registered_credential],
             credential
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"MFA fallita: {str(e)}")
 
-    users.update_one({"_id": user["_id"]}, {"$unset": {"mfa_challenge": ""}})
-
     token = create_access_token({
         "sub": str(user["_id"]),
         "email": user["email"]
@@ -195,18 +200,18 @@ async def mfa_login_complete(request: Request, response: Response):
         max_age=3600
     )
 
+    schedule_agent_provisioning(str(user["_id"]), user["email"])
+
     return {"message": "Login MFA completato"}
 
 @router.get("/list")
-async def list_mfa(access_token: str = Cookie(None)):
+async def list_mfa(principal: Principal = Depends(require_principal)):
     """
     Restituisce lo stato MFA e le chiavi registrate dell'utente.
     """
-    user_id = get_user_id_from_token(access_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Utente non autenticato")
+    user_id = principal.user_id
 
-    user = users.find_one({"_id": ObjectId(user_id)})
+    user = await users.find_one({"_id": ObjectId(user_id)})
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
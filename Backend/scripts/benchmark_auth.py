@@ -0,0 +1,106 @@
+"""
+Micro-benchmark del costo di autenticazione per richiesta (cookie access_token -> utente), misurato attraverso FastAPI.
+
+Ogni variante è una route di un'app minima, chiamata in-process via ASGI con httpx, così la misura include la
+risoluzione delle dipendenze e, per quelle sync, il passaggio nel threadpool:
+- nessuna auth:            costo della sola richiesta, sottratto alle altre righe
+- prima:                   dipendenza sync con due verifiche HMAC e decodifiche dello stesso JWT (user_id ed email)
+- sync, cache:             decode_principal con la cache dei token, ma in una dipendenza sync (threadpool)
+- get_principal:           la dipendenza async usata dalle route
+- require_principal:       get_principal + controllo 401
+
+Non usa il db. Uso (dalla cartella Backend):
+    python scripts/benchmark_auth.py [--requests 5000] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import Cookie, Depends, FastAPI
+from auth import Principal, create_access_token, decode_access_token, decode_principal, get_principal, require_principal
+
+
+def decode_twice(access_token: str = Cookie(None)) -> Optional[str]:
+    # Come prima: user_id ed email letti con due decodifiche separate, in una funzione sync
+    decode_access_token(access_token).get("sub")
+    return decode_access_token(access_token).get("email")
+
+
+def sync_principal(access_token: str = Cookie(None)) -> Optional[Principal]:
+    return decode_principal(access_token)
+
+
+app = FastAPI()
+
+
+@app.get("/none")
+async def no_auth():
+    return {}
+
+
+@app.get("/before")
+async def before(email: Optional[str] = Depends(decode_twice)):
+    return {}
+
+
+@app.get("/sync")
+async def sync_cached(principal: Optional[Principal] = Depends(sync_principal)):
+    return {}
+
+
+@app.get("/principal")
+async def principal_route(principal: Optional[Principal] = Depends(get_principal)):
+    return {}
+
+
+@app.get("/require")
+async def require_route(principal: Principal = Depends(require_principal)):
+    return {}
+
+
+async def per_request_us(client: httpx.AsyncClient, path: str, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            response = await client.get(path)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return (time.perf_counter() - started) / requests * 1_000_000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Costo per richiesta dell'autenticazione tramite cookie access_token")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    token = create_access_token({"sub": "64b7f0c2a1e4d5f6a7b8c9d0", "email": "benchmark@example.com"})
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", cookies={"access_token": token}) as client:
+        # Riscaldamento: cache dei token e threadpool già pronti
+        for path in ("/none", "/before", "/sync", "/principal", "/require"):
+            await per_request_us(client, path, 100, args.concurrency)
+
+        baseline = await per_request_us(client, "/none", args.requests, args.concurrency)
+        print(f"{'nessuna auth':>20}: {baseline:8.1f} µs per richiesta")
+        for name, path in (
+            ("prima (2 decodifiche)", "/before"),
+            ("sync, cache", "/sync"),
+            ("get_principal", "/principal"),
+            ("require_principal", "/require"),
+        ):
+            value = await per_request_us(client, path, args.requests, args.concurrency)
+            print(f"{name:>20}: {value:8.1f} µs per richiesta  (auth: {value - baseline:+.1f} µs)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
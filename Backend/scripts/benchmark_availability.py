@@ -0,0 +1,101 @@
+"""
+Benchmark del motore di disponibilità (services/availability_service.py) su un anno di prenotazioni dense.
+
+Genera un anno di appuntamenti con l'occupazione indicata (frazione degli slot del calendario prenotati) e misura:
+- free_slots_on: orari liberi di un giorno
+- next_free_slots: primi N slot liberi, da inizio anno e in uno scenario pieno in cui il primo slot libero
+  è nell'ultima settimana dell'orizzonte (tutte le finestre di giorni vengono lette)
+Riporta anche quanti slot occupati l'agente avrebbe ricevuto con la vecchia lista grezza.
+
+Al posto della collezione appointments usa una lista ordinata in memoria con la stessa interfaccia find(),
+così viene misurato il calcolo del motore (bitmap per giorno) senza la latenza del db.
+
+Uso (dalla cartella Backend):
+    python scripts/benchmark_availability.py [--occupancy 0.95] [--iterations 200] [--count 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# services.availability_service importa db: il client Mongo è lazy e qui non viene mai usato
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+from services import availability_service
+from services.availability_service import clinic_calendar, free_slots_on, next_free_slots
+from services.appointment_time import to_local, to_utc
+
+
+class MemoryAppointments:
+    # Sottoinsieme di find() usato da load_occupied: filtro per intervallo su start, ordinato come l'indice
+    def __init__(self, starts: list):
+        self.starts = sorted(starts)
+
+    def find(self, query: dict, projection: dict = None):
+        condition = query["start"]
+        first = bisect_left(self.starts, condition["$gte"]) if "$gte" in condition else 0
+        last = bisect_left(self.starts, condition["$lt"]) if "$lt" in condition else len(self.starts)
+        return self._cursor(self.starts[first:last])
+
+    async def _cursor(self, starts: list):
+        for start in starts:
+            yield {"start": start}
+
+
+def booked_year(first_day: date, occupancy: float, full_until: date = None) -> list:
+    starts = []
+    for offset in range(365):
+        day = first_day + timedelta(days=offset)
+        for minutes in clinic_calendar.day_slots(day):
+            if (full_until and day < full_until) or random.random() < occupancy:
+                local = datetime.combine(day, datetime.min.time()) + timedelta(minutes=minutes)
+                starts.append(to_utc(local))
+    return starts
+
+
+async def per_call_us(make_call, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await make_call()
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Latenza del motore di disponibilità su un anno di prenotazioni")
+    parser.add_argument("--occupancy", type=float, default=0.95)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--count", type=int, default=5, help="slot richiesti a next_free_slots")
+    args = parser.parse_args()
+
+    random.seed(0)
+    first_day = date(date.today().year + 1, 1, 1)
+    days = [first_day + timedelta(days=offset) for offset in range(365)]
+    after = datetime.combine(first_day, datetime.min.time())
+
+    starts = booked_year(first_day, args.occupancy)
+    availability_service.appointments = MemoryAppointments(starts)
+    # Formato della vecchia risposta di /tool/appointments/slots, data e ora locali
+    raw_list = json.dumps({"slots": [{"date": to_local(s).strftime("%Y-%m-%d"), "time": to_local(s).strftime("%H:%M")} for s in starts]})
+    print(f"Appuntamenti in un anno: {len(starts)}  occupazione: {args.occupancy:.0%}  (lista grezza per l'agente: {len(raw_list)} caratteri)")
+
+    free_day = await per_call_us(lambda: free_slots_on(random.choice(days)), args.iterations)
+    next_start = await per_call_us(lambda: next_free_slots(after, args.count), args.iterations)
+
+    # Scenario pieno: nessuno slot libero fino all'ultima settimana dell'anno
+    availability_service.appointments = MemoryAppointments(booked_year(first_day, args.occupancy, full_until=days[-7]))
+    next_full = await per_call_us(lambda: next_free_slots(after, args.count), max(1, args.iterations // 10))
+    response = json.dumps({"free_slots": await next_free_slots(after, args.count)})
+
+    print(f"{'free_slots_on (un giorno)':>40}: {free_day:10.1f} µs")
+    print(f"{f'next_free_slots({args.count}) da inizio anno':>40}: {next_start:10.1f} µs")
+    print(f"{f'next_free_slots({args.count}) anno pieno':>40}: {next_full:10.1f} µs  (risposta: {len(response)} caratteri)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
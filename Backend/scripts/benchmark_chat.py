@@ -0,0 +1,164 @@
+"""
+Benchmark end-to-end della chat: client -> backend -> Letta -> tool -> backend.
+
+Pensato per girare offline con un mongod locale, il server Letta stub (scripts/stub_letta.py)
+e il backend in modalità locale, ad esempio:
+    uvicorn scripts.stub_letta:app --port 8283
+    MONGO_URI=mongodb://127.0.0.1:27017 LETTA_BASE_URL=http://127.0.0.1:8283 TOOL_BACKEND_MODE=local \\
+        LETTA_TOOL_TOKEN=benchmark uvicorn main:app --port 8000
+    python scripts/benchmark_chat.py --requests 200 --concurrency 10
+
+Chat lente in parallelo: 500 turni contemporanei con 2 s di latenza simulata del modello e nessun tool
+(lo stub esegue i tool uno alla volta). Con --probe il backend viene interrogato su /auth/me durante il carico,
+per verificare che le altre route restino reattive mentre i turni attendono Letta:
+    STUB_LETTA_DELAY_MS=2000 STUB_LETTA_TOOL= uvicorn scripts.stub_letta:app --port 8283
+    MONGO_URI=mongodb://127.0.0.1:27017 LETTA_BASE_URL=http://127.0.0.1:8283 TOOL_BACKEND_MODE=local \\
+        LETTA_TOOL_TOKEN=benchmark LETTA_MAX_CONCURRENCY=500 uvicorn main:app --port 8000
+    python scripts/benchmark_chat.py --requests 500 --concurrency 500 --users 50 --probe
+
+Latenza per turno prima e dopo il salvataggio dei messaggi lato server: con --three-calls ogni turno ripete
+le tre richieste che faceva il frontend (messaggio utente su /frontend/messages, /letta/ask, risposta su /frontend/messages).
+Il confronto si ottiene lanciando lo stesso carico con e senza l'opzione. In questa modalità una qualsiasi
+risposta non 2xx (o con un campo error) interrompe il benchmark: il confronto vale solo se tutte le scritture riescono.
+
+Uso (dalla cartella Backend):
+    python scripts/benchmark_chat.py [--backend http://127.0.0.1:8000] [--requests 200] [--concurrency 10]
+        [--users 1] [--stream] [--probe] [--three-calls]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# services.message_service importa db: il client Mongo è lazy e qui non viene mai usato
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+from services.message_service import ASSISTANT_ROLE
+
+PROMPT = "Quali sono i miei appuntamenti?"
+
+async def login(client: httpx.AsyncClient) -> str:
+    email = f"benchmark-{uuid.uuid4().hex[:8]}@example.com"
+    password = "benchmark-password"
+    await client.post("/auth/register", json={"email": email, "password": password})
+    response = await client.post("/auth/login", json={"email": email, "password": password})
+    response.raise_for_status()
+    # Il cookie è marcato secure: su http va rimandato esplicitamente
+    return response.cookies["access_token"]
+
+
+def checked(response: httpx.Response) -> dict:
+    # Le route rispondono 200 anche con {"error": ...}: entrambi i casi invalidano la misura
+    response.raise_for_status()
+    body = response.json()
+    if "error" in body:
+        raise RuntimeError(f"{response.request.url.path}: {body['error']}")
+    return body
+
+
+async def ask_three_calls(client: httpx.AsyncClient, token: str) -> tuple:
+    # Turno come lo faceva il frontend prima del salvataggio lato server: tre round trip in sequenza
+    headers = {"Cookie": f"access_token={token}"}
+    started = time.perf_counter()
+    checked(await client.post("/frontend/messages", json={"role": "user", "content": PROMPT}, headers=headers))
+    reply = checked(await client.post("/letta/ask", json={"message": PROMPT}, headers=headers)).get("response")
+    if not reply:
+        raise RuntimeError("/letta/ask: risposta vuota")
+    checked(await client.post("/frontend/messages", json={"role": ASSISTANT_ROLE, "content": reply}, headers=headers))
+    return time.perf_counter() - started, None, 200
+
+
+async def ask(client: httpx.AsyncClient, token: str, stream: bool) -> tuple:
+    headers = {"Cookie": f"access_token={token}"}
+    payload = {"message": PROMPT}
+    started = time.perf_counter()
+
+    if not stream:
+        response = await client.post("/letta/ask", json=payload, headers=headers)
+        return time.perf_counter() - started, None, response.status_code
+
+    first_token = None
+    async with client.stream("POST", "/letta/ask/stream", json=payload, headers=headers) as response:
+        async for line in response.aiter_lines():
+            if first_token is None and '"type": "token"' in line:
+                first_token = time.perf_counter() - started
+    return time.perf_counter() - started, first_token, response.status_code
+
+
+def report(name: str, values: list):
+    if not values:
+        return
+    values = sorted(v * 1000 for v in values)
+    p50 = values[len(values) // 2]
+    p99 = values[int(len(values) * 0.99)]
+    print(f"{name}: media {statistics.mean(values):.1f} ms  p50 {p50:.1f} ms  p99 {p99:.1f} ms")
+
+
+async def probe(client: httpx.AsyncClient, token: str, stop: asyncio.Event) -> list:
+    # Latenza di una route leggera mentre il backend ha i turni di chat in corso
+    headers = {"Cookie": f"access_token={token}"}
+    durations = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.get("/auth/me", headers=headers)
+        durations.append(time.perf_counter() - started)
+        await asyncio.sleep(0.1)
+    return durations
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Latenza end-to-end di /letta/ask")
+    parser.add_argument("--backend", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=1, help="utenti tra cui distribuire le richieste (un agente per utente)")
+    parser.add_argument("--stream", action="store_true", help="usa /letta/ask/stream e misura anche il primo token")
+    parser.add_argument("--three-calls", action="store_true", help="ogni turno salva i messaggi con /frontend/messages come il vecchio frontend")
+    parser.add_argument("--probe", action="store_true", help="misura la latenza di /auth/me durante il carico")
+    args = parser.parse_args()
+
+    # Il limite di connessioni di httpx (100) non deve ridurre la concorrenza richiesta
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.backend, timeout=120, limits=limits) as client, \
+            httpx.AsyncClient(base_url=args.backend, timeout=120) as probe_client:
+        tokens = [await login(client) for _ in range(args.users)]
+        # Primo messaggio fuori misura: crea l'agente di ogni utente
+        await asyncio.gather(*(ask(client, token, args.stream) for token in tokens))
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(i: int):
+            async with semaphore:
+                if args.three_calls:
+                    return await ask_three_calls(client, tokens[i % len(tokens)])
+                return await ask(client, tokens[i % len(tokens)], args.stream)
+
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(probe(probe_client, tokens[0], stop)) if args.probe else None
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        probe_durations = await probe_task if probe_task else []
+
+    rejected = sum(1 for _, _, status in results if status == 503)
+    errors = sum(1 for _, _, status in results if status not in (200, 503))
+    print(
+        f"Richieste: {args.requests}  concorrenza: {args.concurrency}  utenti: {args.users}  "
+        f"errori: {errors}  rifiutate (503): {rejected}  throughput: {args.requests / elapsed:.1f} req/s"
+    )
+    report("Totale", [total for total, _, status in results if status == 200])
+    report("Primo token", [first for _, first, _ in results if first is not None])
+    report("/auth/me durante il carico", probe_durations)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
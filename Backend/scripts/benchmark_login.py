@@ -0,0 +1,79 @@
+"""
+Benchmark dei login concorrenti: latenza (media, p50, p99) e throughput di POST /auth/login.
+
+Pensato per girare contro un mongod locale e il backend in modalità locale. Con BCRYPT_ROUNDS=4 l'hash
+della password pesa poco e la misura riguarda soprattutto le query su users fatte dal data layer, ad esempio:
+    MONGO_URI=mongodb://127.0.0.1:27017 BCRYPT_ROUNDS=4 uvicorn main:app --port 8000
+    python scripts/benchmark_login.py --users 50 --requests 2000 --concurrency 100
+
+Uso (dalla cartella Backend):
+    python scripts/benchmark_login.py [--backend http://127.0.0.1:8000] [--users 20] [--requests 500] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+PASSWORD = "benchmark-password"
+
+
+async def register_users(client: httpx.AsyncClient, count: int) -> list:
+    emails = [f"benchmark-login-{uuid.uuid4().hex[:8]}@example.com" for _ in range(count)]
+    for email in emails:
+        response = await client.post("/auth/register", json={"email": email, "password": PASSWORD})
+        response.raise_for_status()
+    return emails
+
+
+async def login(client: httpx.AsyncClient, email: str) -> tuple:
+    started = time.perf_counter()
+    response = await client.post("/auth/login", json={"email": email, "password": PASSWORD})
+    return time.perf_counter() - started, response.status_code
+
+
+def report(name: str, values: list):
+    if not values:
+        return
+    values = sorted(v * 1000 for v in values)
+    p50 = values[len(values) // 2]
+    p99 = values[int(len(values) * 0.99)]
+    print(f"{name}: media {statistics.mean(values):.1f} ms  p50 {p50:.1f} ms  p99 {p99:.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Latenza di /auth/login con login concorrenti")
+    parser.add_argument("--backend", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=20, help="utenti registrati prima della misura")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.backend, timeout=120, limits=limits) as client:
+        emails = await register_users(client, args.users)
+        # Un login per utente fuori misura: connessioni aperte e pool del db già pieno
+        await asyncio.gather(*(login(client, email) for email in emails))
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(i: int):
+            async with semaphore:
+                return await login(client, emails[i % len(emails)])
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    errors = sum(1 for _, status in results if status != 200)
+    print(
+        f"Login: {args.requests}  concorrenza: {args.concurrency}  utenti: {args.users}  "
+        f"errori: {errors}  throughput: {args.requests / elapsed:.1f} login/s"
+    )
+    report("Login", [duration for duration, status in results if status == 200])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""
+Benchmark di una raffica di login: throughput delle verifiche bcrypt e lag dell'event loop.
+
+Confronta, con N verifiche della password lanciate insieme:
+- inline: pwd_context.verify eseguito direttamente nell'event loop, come facevano register e login
+- pool:   verify_password di auth.py (pool dedicato, limite di concorrenza, 429 oltre PASSWORD_HASH_QUEUE_TIMEOUT)
+
+Durante la raffica un task si risveglia ogni 10 ms e misura il ritardo rispetto al risveglio atteso:
+è il tempo per cui ogni altra richiesta del worker resterebbe ferma.
+
+Non usa il db. Uso (dalla cartella Backend):
+    BCRYPT_ROUNDS=12 python scripts/benchmark_login_storm.py [--logins 50]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from auth import BCRYPT_ROUNDS, PASSWORD_HASH_CONCURRENCY, pwd_context, verify_password
+
+PASSWORD = "benchmark-password"
+LAG_INTERVAL = 0.01
+
+
+async def measure_lag(stop: asyncio.Event) -> list:
+    lags = []
+    while not stop.is_set():
+        expected = time.perf_counter() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - expected))
+    return lags
+
+
+async def storm(logins: int, inline: bool, password_hash: str) -> tuple:
+    async def one():
+        if inline:
+            pwd_context.verify(PASSWORD, password_hash)
+            return 200
+        try:
+            await verify_password(PASSWORD, password_hash)
+            return 200
+        except HTTPException as e:
+            return e.status_code
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    await asyncio.sleep(LAG_INTERVAL * 2)
+
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(one() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    return statuses, elapsed, await lag_task
+
+
+def report(name: str, statuses: list, elapsed: float, lags: list):
+    lags = sorted(lag * 1000 for lag in lags) or [0.0]
+    p99 = lags[int(len(lags) * 0.99)]
+    rejected = sum(1 for status in statuses if status == 429)
+    completed = sum(1 for status in statuses if status == 200)
+    print(
+        f"{name:>6}: {completed / elapsed:6.1f} login/s  rifiutati (429): {rejected}  "
+        f"lag event loop: media {statistics.mean(lags):.1f} ms  p99 {p99:.1f} ms  max {lags[-1]:.1f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Throughput dei login e lag dell'event loop durante una raffica di login")
+    parser.add_argument("--logins", type=int, default=50)
+    args = parser.parse_args()
+
+    password_hash = pwd_context.hash(PASSWORD)
+    print(f"bcrypt rounds: {BCRYPT_ROUNDS}  concorrenza del pool: {PASSWORD_HASH_CONCURRENCY}  login: {args.logins}")
+    report("inline", *await storm(args.logins, True, password_hash))
+    report("pool", *await storm(args.logins, False, password_hash))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
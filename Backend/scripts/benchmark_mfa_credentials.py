@@ -0,0 +1,72 @@
+"""
+Benchmark del costo delle credenziali WebAuthn per utenti con molte passkey.
+
+Confronta, per numero di passkey dell'utente:
+- login/complete: decodifica di tutte le credenziali ad ogni richiesta (prima) contro
+  la sola credenziale usata letta dalla cache (dopo)
+- register/begin: decodifica completa per costruire i descriptor (prima) contro il solo credential_id (dopo)
+
+Non usa il db. Uso (dalla cartella Backend):
+    python scripts/benchmark_mfa_credentials.py [--iterations 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# services.credential_service importa db: il client Mongo è lazy e qui non viene mai usato
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from fido2.cose import ES256
+from fido2.server import to_descriptor
+from fido2.webauthn import AttestedCredentialData
+from services.credential_service import (
+    credential_cache, credential_descriptor, descriptor_cache, credential_record, get_credential, parse_credential
+)
+
+
+def make_records(count: int) -> list:
+    records = []
+    for _ in range(count):
+        public_key = ES256.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()).public_key())
+        cred = AttestedCredentialData.create(aaguid=b"\x00" * 16, credential_id=os.urandom(32), public_key=public_key)
+        records.append(credential_record(cred))
+    return records
+
+
+def per_call_us(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Costo per richiesta della decodifica delle credenziali WebAuthn")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--passkeys", type=int, nargs="+", default=[1, 5, 20, 100])
+    args = parser.parse_args()
+
+    print(f"{'passkey':>8} | {'login prima':>12} {'login dopo':>11} | {'register prima':>15} {'register dopo':>14}  (µs per richiesta)")
+    for count in args.passkeys:
+        records = make_records(count)
+        # La credenziale usata nel login è l'ultima registrata; le cache sono calde come dopo la prima richiesta
+        used = records[-1]
+        credential_cache.clear()
+        descriptor_cache.clear()
+        get_credential("benchmark-user", used)
+        for r in records:
+            credential_descriptor(r)
+
+        login_before = per_call_us(lambda: [parse_credential(r) for r in records], args.iterations)
+        login_after = per_call_us(lambda: get_credential("benchmark-user", used), args.iterations)
+        register_before = per_call_us(lambda: [to_descriptor(parse_credential(r)) for r in records], args.iterations)
+        register_after = per_call_us(lambda: [credential_descriptor(r) for r in records], args.iterations)
+
+        print(f"{count:>8} | {login_before:>12.1f} {login_after:>11.1f} | {register_before:>15.1f} {register_after:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
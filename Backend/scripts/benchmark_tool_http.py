@@ -0,0 +1,106 @@
+"""
+Benchmark locale della latenza per chiamata HTTP dei tool Letta.
+
+Avvia un server stub in loopback che risponde come le route /tool e confronta:
+- "bare":   una requests.get per chiamata, come facevano i tool (nuova connessione ogni volta)
+- "pooled": la sessione condivisa con keep-alive, timeout e retry usata dai tool
+
+Uso (dalla cartella Backend):
+    python scripts/benchmark_tool_http.py [--calls 500] [--delay-ms 0]
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 per permettere il keep-alive
+    protocol_version = "HTTP/1.1"
+    # Header e corpo sono scritti separatamente: senza TCP_NODELAY le risposte su connessioni keep-alive
+    # restano in attesa del delayed ACK del client (~40 ms)
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps({"slots": [], "appointments": [], "message": "ok"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(delay: float) -> ThreadingHTTPServer:
+    StubHandler.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def pooled_session() -> requests.Session:
+    # Stessa configurazione della sessione creata dai tool in services/agent_service.py
+    retry = Retry(
+        total=3, backoff_factor=0.5, backoff_jitter=0.5, status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "PUT", "DELETE"}), raise_on_status=False
+    )
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=10))
+    return session
+
+
+def measure(call, calls: int) -> list:
+    latencies = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:>7}: media {statistics.mean(latencies):.2f} ms  p50 {p50:.2f} ms  p99 {p99:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latenza per chiamata dei tool: connessione nuova vs sessione condivisa")
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--delay-ms", type=float, default=0, help="tempo di risposta simulato del backend")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.delay_ms / 1000)
+    url = f"http://127.0.0.1:{server.server_address[1]}/tool/appointments/slots"
+    headers = {"X-Letta-Token": "benchmark"}
+    timeout = (3.05, 30)
+
+    session = pooled_session()
+    # Riscaldamento: apre la connessione della sessione
+    session.get(url, headers=headers, timeout=timeout)
+
+    report("bare", measure(lambda: requests.get(url, headers=headers), args.calls))
+    report("pooled", measure(lambda: session.get(url, headers=headers, timeout=timeout), args.calls))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark della registrazione dei tool all'avvio del backend (services/agent_service.py), contro il server Letta stub.
+
+Misura quanto l'avvio resta bloccato dalla registrazione dei tool in tre casi:
+- a freddo:      registro vuoto, tutti i tool vengono inviati a Letta con tools.upsert
+- a caldo:       registro già aggiornato, l'hash del sorgente coincide e nessun tool viene inviato
+- in background: registro vuoto con TOOLS_REGISTER_BACKGROUND, l'avvio attende solo start_tools_registration;
+                 viene riportato anche il tempo fino a tools_ready (registrazione completata)
+
+Al posto della collezione tool_registry usa un registro in memoria con la stessa interfaccia find()/update_one(),
+così non serve un mongod e viene misurata solo la latenza verso Letta.
+
+Uso (dalla cartella Backend):
+    uvicorn scripts.stub_letta:app --port 8283
+    python scripts/benchmark_tool_registration.py [--letta http://127.0.0.1:8283] [--rounds 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# services.agent_service importa db: il client Mongo è lazy e qui non viene mai usato
+os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+
+
+class MemoryRegistry:
+    # Sottoinsieme dell'interfaccia di tool_registry usato dalla registrazione dei tool
+    def __init__(self):
+        self.docs = {}
+        self.writes = 0
+
+    def find(self, query: dict):
+        return self._cursor(list(self.docs.values()))
+
+    async def _cursor(self, docs: list):
+        for doc in docs:
+            yield doc
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        self.writes += 1
+        self.docs.setdefault(query["name"], dict(query)).update(update["$set"])
+
+
+def reset(agent_service, registry: MemoryRegistry):
+    agent_service.tool_registry = registry
+    agent_service.registered_tools.clear()
+    agent_service.registered_tool_ids.clear()
+    agent_service.tools_ready.clear()
+
+
+def summary(values: list) -> str:
+    values = sorted(values)
+    return f"p50 {statistics.median(values):8.2f} ms   max {values[-1]:8.2f} ms"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Latenza di avvio dovuta alla registrazione dei tool su Letta")
+    parser.add_argument("--letta", default="http://127.0.0.1:8283", help="URL del server Letta stub")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    # I client Letta leggono l'URL all'import del modulo
+    os.environ["LETTA_BASE_URL"] = args.letta
+    from services import agent_service
+
+    cold, warm, background, background_ready = [], [], [], []
+    cold_writes = warm_writes = 0
+    for _ in range(args.rounds):
+        registry = MemoryRegistry()
+
+        reset(agent_service, registry)
+        started = time.perf_counter()
+        await agent_service.register_tools_on_startup()
+        cold.append((time.perf_counter() - started) * 1000)
+        cold_writes = registry.writes
+
+        # Stesso registro, ora aggiornato: nessuna chiamata a Letta
+        registry.writes = 0
+        reset(agent_service, registry)
+        started = time.perf_counter()
+        await agent_service.register_tools_on_startup()
+        warm.append((time.perf_counter() - started) * 1000)
+        warm_writes = registry.writes
+
+        reset(agent_service, MemoryRegistry())
+        started = time.perf_counter()
+        agent_service.start_tools_registration()
+        background.append((time.perf_counter() - started) * 1000)
+        await agent_service.tools_ready.wait()
+        background_ready.append((time.perf_counter() - started) * 1000)
+
+    print(f"Tool: {len(agent_service.TOOL_FUNCTIONS)}  round: {args.rounds}  Letta: {args.letta}")
+    print(f"{'a freddo':>24}: {summary(cold)}  (upsert: {cold_writes})")
+    print(f"{'a caldo (hash uguale)':>24}: {summary(warm)}  (upsert: {warm_writes})")
+    print(f"{'in background':>24}: {summary(background)}")
+    print(f"{'  fino a tools_ready':>24}: {summary(background_ready)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,185 @@
+"""
+Verifica con explain() che le query più frequenti usino gli indici dichiarati in indexes.py.
+
+Crea un db di prova, vi crea gli indici dichiarati (ensure_indexes), inserisce dati sintetici e per ogni query
+controlla il piano vincente: tutte le scansioni devono essere IXSCAN sull'indice atteso (o la lettura diretta per _id),
+senza COLLSCAN e, per le query ordinate, senza SORT in memoria. Esce con codice 1 se un controllo fallisce.
+Il db di prova viene eliminato alla fine.
+
+Query controllate:
+- appointments: slot occupati per intervallo su start (tool slots e motore di disponibilità)
+- appointments: appuntamenti di un utente per (user_id, start), con e senza intervallo
+- messages: pagine dello storico a chiave su (user_id, created_at, _id), prima pagina e pagine successive
+- mfa_challenges: consumo della sfida per _id e scansione TTL su expires_at
+- users: proprietario di una credenziale WebAuthn per credential_id
+
+Pensato per girare contro un mongod locale, ad esempio:
+    MONGO_URI=mongodb://127.0.0.1:27017 python scripts/check_indexes_explain.py
+
+Uso (dalla cartella Backend):
+    python scripts/check_indexes_explain.py [--db explain_check] [--users 50] [--docs 5000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Controlla con explain() gli indici usati dalle query principali")
+    parser.add_argument("--db", default="explain_check", help="nome del db di prova, eliminato alla fine")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--docs", type=int, default=5000, help="appuntamenti e messaggi da inserire")
+    return parser.parse_args()
+
+
+# Il db va scelto prima di importare db.py, che legge MONGO_DB_NAME all'import
+args = parse_args()
+os.environ["MONGO_DB_NAME"] = args.db
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import ASCENDING, DESCENDING
+from db import appointments, client, close_db, messages, mfa_challenges, users
+from indexes import ensure_indexes
+from services.appointment_time import day_range
+
+# Letture dirette per _id: non compaiono come IXSCAN ma usano comunque l'indice _id_
+ID_LOOKUP_STAGES = ("IDHACK", "EXPRESS_IXSCAN")
+
+
+def plan_stages(stage: dict) -> list:
+    # Stadi del piano in profondità; con il motore SBE il piano vero è in queryPlan
+    if "queryPlan" in stage:
+        stage = stage["queryPlan"]
+    stages = [stage]
+    children = stage.get("inputStages", []) + ([stage["inputStage"]] if "inputStage" in stage else [])
+    for child in children:
+        stages += plan_stages(child)
+    return stages
+
+
+def check_plan(explain: dict, index_name: str, sorted_query: bool) -> list:
+    """
+    Problemi del piano vincente rispetto all'indice atteso (lista vuota se il piano è quello giusto).
+    """
+    stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+    names = [stage["stage"] for stage in stages]
+    problems = []
+    if "COLLSCAN" in names:
+        problems.append("COLLSCAN")
+
+    scans = [stage for stage in stages if stage["stage"] == "IXSCAN" or stage["stage"] in ID_LOOKUP_STAGES]
+    if not scans:
+        problems.append(f"nessuna scansione su indice ({' > '.join(names)})")
+    for stage in scans:
+        used = "_id_" if stage["stage"] in ID_LOOKUP_STAGES else stage.get("indexName")
+        if used != index_name:
+            problems.append(f"{stage['stage']} su {used}")
+
+    if sorted_query and "SORT" in names:
+        problems.append("SORT in memoria")
+    return problems
+
+
+async def seed(user_ids: list, docs: int):
+    random.seed(0)
+    first = datetime(2099, 1, 1, 8)
+
+    await users.insert_many([
+        {
+            "_id": ObjectId(user_id),
+            "email": f"explain-{i}@example.com",
+            # Metà degli utenti ha una chiave WebAuthn, come quando l'MFA è facoltativa
+            **({"webauthn_credentials": [{"credential_id": f"cred-{i}", "sign_count": 0}]} if i % 2 == 0 else {})
+        }
+        for i, user_id in enumerate(user_ids)
+    ])
+    # Un appuntamento ogni 30 minuti: gli inizi sono unici come richiesto dall'indice start
+    await appointments.insert_many([
+        {"user_id": random.choice(user_ids), "start": first + timedelta(minutes=30 * i), "duration_minutes": 30}
+        for i in range(docs)
+    ])
+    await messages.insert_many([
+        {
+            "user_id": random.choice(user_ids),
+            "role": "user",
+            "content": "messaggio di prova",
+            "created_at": first + timedelta(seconds=i // 2)
+        }
+        for i in range(docs)
+    ])
+    now = datetime.utcnow()
+    await mfa_challenges.insert_many([
+        {"_id": f"ceremony-{i}", "user_id": random.choice(user_ids), "expires_at": now + timedelta(seconds=random.randint(-300, 300))}
+        for i in range(docs // 10)
+    ])
+
+
+async def main():
+    user_ids = [str(ObjectId()) for _ in range(args.users)]
+    user_id = user_ids[0]
+    first_day = datetime(2099, 1, 10).date()
+    last_day = datetime(2099, 1, 20).date()
+
+    try:
+        await client.drop_database(args.db)
+        reports = await ensure_indexes()
+        failed_indexes = {name: report["failed"] for name, report in reports.items() if report["failed"]}
+        if failed_indexes:
+            print(f"Creazione degli indici fallita: {failed_indexes}")
+            return 1
+        await seed(user_ids, args.docs)
+
+        # Pagina successiva dello storico: cursore sull'ultimo messaggio di una pagina
+        message_sort = [("created_at", DESCENDING), ("_id", DESCENDING)]
+        last = await messages.find_one({"user_id": user_id}, sort=message_sort, skip=20) or await messages.find_one({}, sort=message_sort)
+        keyset = {"user_id": user_id, "$or": [
+            {"created_at": {"$lt": last["created_at"]}},
+            {"created_at": last["created_at"], "_id": {"$lt": last["_id"]}}
+        ]}
+
+        # (descrizione, cursore, indice atteso, query ordinata)
+        checks = [
+            ("appointments: slot per intervallo su start",
+             appointments.find(day_range(first_day, last_day), {"_id": 0, "start": 1}).sort("start", ASCENDING), "start", True),
+            ("appointments: slot da una data in poi",
+             appointments.find(day_range(first_day), {"_id": 0, "start": 1}).sort("start", ASCENDING), "start", True),
+            ("appointments: appuntamenti di un utente",
+             appointments.find({"user_id": user_id}).sort("start", ASCENDING), "user_id_start", True),
+            ("appointments: appuntamenti di un utente per intervallo",
+             appointments.find({"user_id": user_id, **day_range(first_day, last_day)}).sort("start", ASCENDING), "user_id_start", True),
+            ("messages: prima pagina dello storico",
+             messages.find({"user_id": user_id}).sort(message_sort).limit(21), "user_id_created_at_id", True),
+            ("messages: pagina successiva (keyset)",
+             messages.find(keyset).sort(message_sort).limit(21), "user_id_created_at_id", True),
+            ("messages: esportazione completa",
+             messages.find({"user_id": user_id}).sort([("created_at", ASCENDING), ("_id", ASCENDING)]), "user_id_created_at_id", True),
+            ("mfa_challenges: consumo della sfida",
+             mfa_challenges.find({"_id": "ceremony-1", "expires_at": {"$gt": datetime.utcnow()}}).limit(1), "_id_", False),
+            ("mfa_challenges: sfide scadute (TTL)",
+             mfa_challenges.find({"expires_at": {"$lt": datetime.utcnow()}}), "expires_at", False),
+            ("users: proprietario della credenziale WebAuthn",
+             users.find({"webauthn_credentials.credential_id": "cred-2"}, {"email": 1, "webauthn_credentials.$": 1}).limit(1),
+             "webauthn_credential_id", False),
+        ]
+
+        failures = 0
+        for description, cursor, index_name, sorted_query in checks:
+            problems = check_plan(await cursor.explain(), index_name, sorted_query)
+            failures += bool(problems)
+            outcome = "ok" if not problems else "ERRORE: " + "; ".join(problems)
+            print(f"{description:>55}  [{index_name}]  {outcome}")
+
+        print(f"{len(checks) - failures}/{len(checks)} query servite dall'indice atteso")
+        return 1 if failures else 0
+    finally:
+        await client.drop_database(args.db)
+        await close_db()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
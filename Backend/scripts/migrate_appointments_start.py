@@ -0,0 +1,100 @@
+"""
+Migrazione una tantum degli appuntamenti salvati con date e time come stringhe libere.
+
+Per ogni appuntamento senza start normalizza data e ora, calcola l'inizio in UTC e la durata,
+poi rimuove gli indici su (date, time) e (user_id, created_at) sostituiti da quelli su start.
+
+Uso (dalla cartella Backend):
+    python scripts/migrate_appointments_start.py [--dry-run] [--batch-size 500]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db import appointments, close_db
+from indexes import ensure_indexes
+from services.appointment_time import AppointmentTimeError, appointment_fields
+
+LEGACY_INDEXES = ("date_time", "user_id_created_at")
+
+
+async def flush(operations: list, ids: list, report: dict, dry_run: bool):
+    if not operations or dry_run:
+        report["migrated"] += len(operations)
+        return
+
+    try:
+        result = await appointments.bulk_write(operations, ordered=False)
+        report["migrated"] += result.modified_count
+    except BulkWriteError as e:
+        # Con ordered=False le altre modifiche del blocco vengono comunque applicate
+        report["migrated"] += e.details.get("nModified", 0)
+        for error in e.details.get("writeErrors", []):
+            appointment_id = ids[error["index"]]
+            if error.get("code") == 11000:
+                # Due appuntamenti che dopo la normalizzazione cadono nello stesso slot
+                report["conflicts"].append(str(appointment_id))
+            else:
+                report["errors"].append(f"{appointment_id}: {error.get('errmsg')}")
+
+
+async def migrate(batch_size: int, dry_run: bool) -> dict:
+    report = {"migrated": 0, "invalid": [], "conflicts": [], "errors": []}
+
+    # L'indice unique su start deve esistere prima della migrazione, così i conflitti vengono rilevati
+    if not dry_run:
+        await ensure_indexes()
+
+    operations, ids = [], []
+    cursor = appointments.find({"start": {"$exists": False}}, {"date": 1, "time": 1})
+    async for appt in cursor:
+        try:
+            fields = appointment_fields(appt.get("date") or "", appt.get("time") or "")
+        except AppointmentTimeError as e:
+            report["invalid"].append(f"{appt['_id']}: {e}")
+            continue
+
+        operations.append(UpdateOne({"_id": appt["_id"]}, {"$set": fields}))
+        ids.append(appt["_id"])
+        if len(operations) >= batch_size:
+            await flush(operations, ids, report, dry_run)
+            operations, ids = [], []
+
+    await flush(operations, ids, report, dry_run)
+
+    if not dry_run:
+        existing = await appointments.index_information()
+        for name in LEGACY_INDEXES:
+            if name in existing:
+                await appointments.drop_index(name)
+                print(f"Indice {name} rimosso")
+
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Aggiunge start e duration_minutes agli appuntamenti esistenti")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="mostra cosa verrebbe migrato senza scrivere")
+    args = parser.parse_args()
+
+    try:
+        report = await migrate(args.batch_size, args.dry_run)
+    finally:
+        await close_db()
+
+    print(f"Appuntamenti migrati: {report['migrated']}")
+    for kind, label in (("invalid", "Data o ora non valide"), ("conflicts", "Slot già occupato"), ("errors", "Errori")):
+        if report[kind]:
+            print(f"{label} ({len(report[kind])}):")
+            for item in report[kind]:
+                print(f"  {item}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+"""
+Allinea gli indici esistenti alla dichiarazione di indexes.py.
+
+All'avvio il backend crea solo gli indici mancanti e segnala quelli con chiavi o opzioni diverse (drift).
+Questo script li sostituisce, da eseguire una sola volta (non da ogni worker) dopo aver controllato il report:
+l'indice dichiarato viene creato dopo un indice ponte sulle stesse chiavi, così le query restano servite da un indice
+anche se la creazione fallisce; gli indici unique su dati con duplicati vengono saltati e segnalati.
+
+Uso (dalla cartella Backend):
+    python scripts/rebuild_indexes.py [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import close_db
+from indexes import ensure_indexes
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Sostituisce gli indici non conformi alla dichiarazione")
+    parser.add_argument("--dry-run", action="store_true", help="mostra solo le differenze, senza creare o modificare indici")
+    args = parser.parse_args()
+
+    try:
+        reports = await ensure_indexes(rebuild=True, dry_run=args.dry_run)
+    finally:
+        await close_db()
+
+    for name, report in reports.items():
+        for kind in ("created", "rebuilt", "missing", "drift", "extra", "failed"):
+            for item in report[kind]:
+                print(f"{name} ({kind}): {item}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+Stress test della prenotazione atomica degli slot: centinaia di richieste parallele per lo stesso slot.
+
+Fase "create": N POST /tool/appointments contemporanee con la stessa data e ora.
+Fase "update": N appuntamenti in slot diversi spostati tutti insieme con PUT sullo stesso slot.
+In entrambe le fasi deve riuscire esattamente una richiesta e le altre devono ricevere 409; alla fine
+viene controllato che nel db ci sia un solo appuntamento nello slot. Gli appuntamenti creati vengono cancellati.
+
+Pensato per girare contro un mongod locale e il backend in modalità locale, ad esempio:
+    MONGO_URI=mongodb://127.0.0.1:27017 LETTA_TOOL_TOKEN=benchmark uvicorn main:app --port 8000
+    python scripts/stress_slot_booking.py --requests 500
+
+Uso (dalla cartella Backend):
+    python scripts/stress_slot_booking.py [--backend http://127.0.0.1:8000] [--token benchmark] [--requests 300]
+        [--date 2099-03-02] [--time 10:00]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+
+import httpx
+
+
+async def create_user(client: httpx.AsyncClient) -> tuple:
+    email = f"stress-{uuid.uuid4().hex[:8]}@example.com"
+    password = "stress-password"
+    response = await client.post("/auth/register", json={"email": email, "password": password})
+    response.raise_for_status()
+    response = await client.post("/auth/login", json={"email": email, "password": password})
+    response.raise_for_status()
+    # Il cookie è marcato secure: su http va rimandato esplicitamente
+    me = await client.get("/auth/me", headers={"Cookie": f"access_token={response.cookies['access_token']}"})
+    return me.json()["user"]["sub"], email
+
+
+async def fire(requests: list) -> tuple:
+    # Tutte le richieste partono insieme: ognuna attende l'evento prima di essere inviata
+    go = asyncio.Event()
+
+    async def one(send):
+        await go.wait()
+        started = time.perf_counter()
+        try:
+            response = await send()
+            return response.status_code, time.perf_counter() - started
+        except httpx.HTTPError as e:
+            return type(e).__name__, time.perf_counter() - started
+
+    tasks = [asyncio.create_task(one(send)) for send in requests]
+    await asyncio.sleep(0)
+    go.set()
+    results = await asyncio.gather(*tasks)
+    return Counter(status for status, _ in results), [elapsed for _, elapsed in results]
+
+
+def report(phase: str, statuses: Counter, durations: list) -> bool:
+    values = sorted(v * 1000 for v in durations)
+    p50 = values[len(values) // 2]
+    p99 = values[int(len(values) * 0.99)]
+    print(f"{phase}: {dict(statuses)}  media {statistics.mean(values):.1f} ms  p50 {p50:.1f} ms  p99 {p99:.1f} ms")
+    ok = statuses.get(200, 0) == 1 and statuses.get(409, 0) == sum(statuses.values()) - 1
+    if not ok:
+        print(f"{phase}: ERRORE, attese 1 risposta 200 e {sum(statuses.values()) - 1} risposte 409")
+    return ok
+
+
+async def appointments_in_slot(client: httpx.AsyncClient, user_id: str, day: str, slot_time: str) -> list:
+    response = await client.get(f"/tool/appointments/{user_id}", params={"from": day, "to": day})
+    response.raise_for_status()
+    return [appt for appt in response.json()["appointments"] if appt["time"] == slot_time]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Prenotazioni parallele dello stesso slot")
+    parser.add_argument("--backend", default="http://127.0.0.1:8000")
+    parser.add_argument("--token", default="benchmark", help="valore di LETTA_TOOL_TOKEN del backend")
+    parser.add_argument("--requests", type=int, default=300)
+    # Di default una data lontana, per non toccare appuntamenti reali
+    parser.add_argument("--date", default=(date(2099, 1, 1) + timedelta(days=random.randrange(300))).isoformat())
+    parser.add_argument("--time", default="10:00")
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.requests, max_keepalive_connections=args.requests)
+    headers = {"X-Letta-Token": args.token}
+    passed = True
+
+    async with httpx.AsyncClient(base_url=args.backend, headers=headers, limits=limits, timeout=60) as client:
+        user_id, email = await create_user(client)
+        created = []
+        try:
+            # Fase create: stesso slot per tutte le richieste
+            slot = {"user_id": user_id, "email": email, "date": args.date, "time": args.time}
+            statuses, durations = await fire([
+                lambda: client.post("/tool/appointments", json=slot) for _ in range(args.requests)
+            ])
+            passed &= report("create", statuses, durations)
+            booked = await appointments_in_slot(client, user_id, args.date, args.time)
+            created += [appt["appointment_id"] for appt in booked]
+            passed &= len(booked) == 1
+
+            # Fase update: un appuntamento per giorno successivo, poi tutti spostati nello stesso slot del giorno seguente
+            first_day = date.fromisoformat(args.date) + timedelta(days=1)
+            target_day = (first_day + timedelta(days=args.requests)).isoformat()
+            for i in range(args.requests):
+                day = (first_day + timedelta(days=i)).isoformat()
+                response = await client.post("/tool/appointments", json={**slot, "date": day})
+                response.raise_for_status()
+                created += [appt["appointment_id"] for appt in await appointments_in_slot(client, user_id, day, args.time)]
+
+            moves = {"user_id": user_id, "date": target_day, "time": args.time}
+            statuses, durations = await fire([
+                (lambda appointment_id=appointment_id: client.put(f"/tool/appointments/{appointment_id}", json=moves))
+                for appointment_id in created[1:]
+            ])
+            passed &= report("update", statuses, durations)
+            passed &= len(await appointments_in_slot(client, user_id, target_day, args.time)) == 1
+        finally:
+            for appointment_id in created:
+                await client.request("DELETE", f"/tool/appointments/{appointment_id}", json={"user_id": user_id})
+
+    print("OK: un solo appuntamento per slot" if passed else "FALLITO: slot prenotato più di una volta o errori inattesi")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
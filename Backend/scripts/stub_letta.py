@@ -0,0 +1,160 @@
+"""
+Server Letta stub per benchmark end-to-end offline.
+
+Implementa solo le API usate da services/agent_service.py (tool, blocchi, agenti, messaggi e streaming).
+Ad ogni messaggio esegue in-process un tool registrato, con i secret dell'agente come variabili d'ambiente,
+come farebbe il sandbox di Letta: le chiamate dei tool raggiungono quindi il backend vero su BACKEND_BASE_URL.
+L'header traceparent del messaggio viene passato al tool come TRACEPARENT, così la callback del tool
+continua la traccia del turno di chat.
+
+Uso (dalla cartella Backend):
+    uvicorn scripts.stub_letta:app --port 8283
+    LETTA_BASE_URL=http://127.0.0.1:8283 TOOL_BACKEND_MODE=local uvicorn main:app --port 8000
+
+Variabili:
+    STUB_LETTA_TOOL       tool eseguito ad ogni messaggio (default get_user_appointments, vuoto = nessun tool)
+    STUB_LETTA_TOOL_ARGS  argomenti del tool in JSON (default {})
+    STUB_LETTA_DELAY_MS   latenza simulata del modello per ogni messaggio (default 0)
+"""
+import ast
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+STUB_LETTA_TOOL = os.getenv("STUB_LETTA_TOOL", "get_user_appointments")
+STUB_LETTA_TOOL_ARGS = json.loads(os.getenv("STUB_LETTA_TOOL_ARGS", "{}"))
+STUB_LETTA_DELAY_MS = float(os.getenv("STUB_LETTA_DELAY_MS", "0"))
+
+app = FastAPI(title="Letta stub")
+
+tools = {}
+blocks = {}
+agents = {}
+
+# I tool leggono i secret da os.environ: l'esecuzione è serializzata per non mescolare gli ambienti di agenti diversi
+_env_lock = threading.Lock()
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def _run_tool(agent: dict, name: str, args: dict, traceparent: Optional[str] = None):
+    func = tools.get(name, {}).get("func")
+    if func is None:
+        return {"status": "error", "message": f"Tool {name} non registrato"}, 0.0
+
+    env = {**agent["secrets"], "TRACEPARENT": traceparent}
+    with _env_lock:
+        previous = {key: os.environ.get(key) for key in env}
+        os.environ.update({key: value for key, value in env.items() if value is not None})
+        started = time.perf_counter()
+        try:
+            result = func(**args)
+        finally:
+            elapsed = time.perf_counter() - started
+            for key, value in previous.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+    return result, elapsed
+
+
+async def _agent_turn(agent_id: str, traceparent: Optional[str] = None) -> list:
+    agent = agents.get(agent_id)
+    if agent is None:
+        # Lo stub non conserva gli agenti tra un riavvio e l'altro: va svuotata user_agents del db di benchmark
+        raise HTTPException(status_code=404, detail=f"Agente {agent_id} non trovato")
+    messages = []
+
+    if STUB_LETTA_TOOL:
+        result, elapsed = await asyncio.to_thread(_run_tool, agent, STUB_LETTA_TOOL, STUB_LETTA_TOOL_ARGS, traceparent)
+        messages.append({
+            "id": f"message-{uuid.uuid4()}", "date": _now(), "message_type": "tool_call_message",
+            "tool_call": {"name": STUB_LETTA_TOOL, "arguments": json.dumps(STUB_LETTA_TOOL_ARGS), "tool_call_id": "stub"}
+        })
+        messages.append({
+            "id": f"message-{uuid.uuid4()}", "date": _now(), "message_type": "tool_return_message",
+            "name": STUB_LETTA_TOOL, "status": "success" if result.get("status") == "success" else "error",
+            "tool_return": json.dumps(result), "tool_call_id": "stub"
+        })
+        print(f"Tool {STUB_LETTA_TOOL}: {elapsed * 1000:.1f} ms")
+
+    if STUB_LETTA_DELAY_MS:
+        await asyncio.sleep(STUB_LETTA_DELAY_MS / 1000)
+
+    messages.append({
+        "id": f"message-{uuid.uuid4()}", "date": _now(), "message_type": "assistant_message",
+        "content": "Risposta dello stub"
+    })
+    return messages
+
+
+@app.put("/v1/tools/")
+async def upsert_tool(request: Request):
+    data = await request.json()
+    source_code = data["source_code"]
+    # Come Letta: il tool è l'ultima funzione del sorgente, le precedenti sono helper
+    name = [node.name for node in ast.walk(ast.parse(source_code)) if isinstance(node, ast.FunctionDef)][-1]
+
+    namespace = {}
+    exec(source_code, namespace)
+    tool_id = tools.get(name, {}).get("id") or f"tool-{uuid.uuid4()}"
+    tools[name] = {"id": tool_id, "func": namespace[name]}
+    return {"id": tool_id, "name": name, "source_code": source_code}
+
+
+@app.post("/v1/blocks/")
+async def create_block(request: Request):
+    data = await request.json()
+    block_id = f"block-{uuid.uuid4()}"
+    blocks[block_id] = data
+    return {"id": block_id, **data}
+
+
+@app.delete("/v1/blocks/{block_id}")
+async def delete_block(block_id: str):
+    blocks.pop(block_id, None)
+    return {}
+
+
+@app.post("/v1/agents/")
+async def create_agent(request: Request):
+    data = await request.json()
+    agent_id = f"agent-{uuid.uuid4()}"
+    agents[agent_id] = {"id": agent_id, "name": data.get("name"), "secrets": data.get("secrets") or {}}
+    return {"id": agent_id, "name": data.get("name")}
+
+
+@app.patch("/v1/agents/{agent_id}")
+async def update_agent(agent_id: str, request: Request):
+    data = await request.json()
+    agent = agents.setdefault(agent_id, {"id": agent_id, "name": agent_id, "secrets": {}})
+    if data.get("secrets") is not None:
+        agent["secrets"] = data["secrets"]
+    return {"id": agent_id, "name": agent["name"]}
+
+
+@app.post("/v1/agents/{agent_id}/messages")
+async def send_message(agent_id: str, traceparent: Optional[str] = Header(None)):
+    return {"messages": await _agent_turn(agent_id, traceparent), "usage": {}}
+
+
+@app.post("/v1/agents/{agent_id}/messages/stream")
+async def stream_message(agent_id: str, traceparent: Optional[str] = Header(None)):
+    messages = await _agent_turn(agent_id, traceparent)
+
+    async def events():
+        for message in messages:
+            yield f"data: {json.dumps(message)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,91 @@
+"""
+Legge il file di tracce scritto dal backend (TRACE_EXPORT_FILE, OTLP/JSON una riga per batch) e stampa,
+per ogni turno di chat, l'albero degli span con durata e offset dall'inizio del turno.
+Gli span sul percorso critico sono marcati con *; per ogni turno vengono riassunte le callback dei tool.
+
+Uso (dalla cartella Backend):
+    python scripts/trace_report.py traces.jsonl [--last 10] [--trace <trace_id>]
+"""
+import argparse
+import json
+from collections import defaultdict
+
+
+def load_spans(path: str) -> dict:
+    # trace_id -> span
+    traces = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    for span in scope_spans["spans"]:
+                        span["start"] = int(span["startTimeUnixNano"])
+                        span["end"] = int(span["endTimeUnixNano"])
+                        span["attrs"] = {a["key"]: next(iter(a["value"].values())) for a in span.get("attributes", [])}
+                        traces[span["traceId"]].append(span)
+    return traces
+
+
+def critical_path(span: dict, children: dict) -> set:
+    # Da ogni span si scende nel figlio che termina per ultimo: è quello che ne determina la durata
+    path = {span["spanId"]}
+    kids = children.get(span["spanId"])
+    if kids:
+        path |= critical_path(max(kids, key=lambda s: s["end"]), children)
+    return path
+
+
+def print_tree(span: dict, children: dict, critical: set, origin: int, depth: int = 0):
+    duration = (span["end"] - span["start"]) / 1e6
+    offset = (span["start"] - origin) / 1e6
+    marker = "*" if span["spanId"] in critical else " "
+    error = " ERRORE" if span.get("status", {}).get("code") == 2 else ""
+    print(f"{marker} {'  ' * depth}{span['name']}  {duration:.1f} ms  (+{offset:.1f} ms){error}")
+    for child in sorted(children.get(span["spanId"], []), key=lambda s: s["start"]):
+        print_tree(child, children, critical, origin, depth + 1)
+
+
+def report(trace_id: str, spans: list):
+    ids = {span["spanId"] for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        if span.get("parentSpanId") in ids:
+            children[span["parentSpanId"]].append(span)
+        else:
+            roots.append(span)
+
+    print(f"Traccia {trace_id}")
+    for root in sorted(roots, key=lambda s: s["start"]):
+        print_tree(root, children, critical_path(root, children), root["start"])
+
+    callbacks = [span for span in spans if span["attrs"].get("tool.callback")]
+    if callbacks:
+        total = sum(span["end"] - span["start"] for span in callbacks) / 1e6
+        mongo = sum(1 for span in spans if span["name"].startswith("mongo."))
+        print(f"  callback dei tool: {len(callbacks)}  tempo totale {total:.1f} ms  comandi mongo nella traccia: {mongo}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Percorso critico e fan-out dei tool per turno di chat")
+    parser.add_argument("path")
+    parser.add_argument("--last", type=int, default=10, help="numero di turni da mostrare (i più recenti)")
+    parser.add_argument("--trace", help="mostra solo questa traccia")
+    args = parser.parse_args()
+
+    traces = load_spans(args.path)
+    if args.trace:
+        selected = [args.trace] if args.trace in traces else []
+    else:
+        turns = [tid for tid, spans in traces.items() if any(span["name"] == "chat.turn" for span in spans)]
+        selected = sorted(turns, key=lambda tid: min(span["start"] for span in traces[tid]))[-args.last:]
+
+    for trace_id in selected:
+        report(trace_id, traces[trace_id])
+
+
+if __name__ == "__main__":
+    main()
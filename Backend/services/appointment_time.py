@@ -0,0 +1,80 @@
+import os
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Gli orari indicati dagli utenti sono nel fuso dell'ambulatorio; nel db l'inizio dell'appuntamento è salvato in UTC
+CLINIC_TIMEZONE = os.getenv("CLINIC_TIMEZONE", "Europe/Rome")
+CLINIC_TZ = ZoneInfo(CLINIC_TIMEZONE)
+APPOINTMENT_DURATION_MINUTES = int(os.getenv("APPOINTMENT_DURATION_MINUTES", os.getenv("CLINIC_SLOT_MINUTES", "30")))
+
+# Formati accettati in ingresso (es. "2025-3-1", "01/03/2025", "9:30", "9.30")
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+TIME_FORMATS = ("%H:%M", "%H.%M", "%H:%M:%S", "%H")
+
+class AppointmentTimeError(ValueError):
+    """
+    Data o ora dell'appuntamento non interpretabili.
+    """
+
+def parse_date(value: str) -> date:
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except (AttributeError, ValueError):
+            continue
+    raise AppointmentTimeError(f"Data non valida: {value}. Usa il formato YYYY-MM-DD")
+
+def parse_time(value: str) -> time:
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).time()
+        except (AttributeError, ValueError):
+            continue
+    raise AppointmentTimeError(f"Ora non valida: {value}. Usa il formato HH:MM")
+
+def normalize_date(value: str) -> str:
+    return parse_date(value).strftime("%Y-%m-%d")
+
+def normalize_time(value: str) -> str:
+    return parse_time(value).strftime("%H:%M")
+
+def to_utc(local: datetime) -> datetime:
+    # pymongo restituisce datetime naive in UTC: si salva nello stesso formato
+    return local.replace(tzinfo=CLINIC_TZ).astimezone(timezone.utc).replace(tzinfo=None)
+
+def to_local(start: datetime) -> datetime:
+    return start.replace(tzinfo=timezone.utc).astimezone(CLINIC_TZ).replace(tzinfo=None)
+
+def appointment_start(date_value: str, time_value: str) -> datetime:
+    """
+    Inizio dell'appuntamento in UTC a partire da data e ora locali dell'ambulatorio.
+    """
+    return to_utc(datetime.combine(parse_date(date_value), parse_time(time_value)))
+
+def day_range(first_day: date = None, last_day: date = None) -> dict:
+    """
+    Filtro Mongo sul campo start per i giorni locali tra first_day e last_day (inclusi).
+    La condizione $type ricalca il filtro dell'indice parziale su start, così il planner può usarlo.
+    """
+    condition = {"$type": "date"}
+    if first_day:
+        condition["$gte"] = to_utc(datetime.combine(first_day, time.min))
+    if last_day:
+        condition["$lt"] = to_utc(datetime.combine(last_day + timedelta(days=1), time.min))
+    return {"start": condition}
+
+def clinic_now() -> datetime:
+    return datetime.now(CLINIC_TZ).replace(tzinfo=None)
+
+def appointment_fields(date_value: str, time_value: str) -> dict:
+    """
+    Campi data/ora da salvare: data e ora locali normalizzate, inizio in UTC e durata.
+    """
+    normalized_date = normalize_date(date_value)
+    normalized_time = normalize_time(time_value)
+    return {
+        "date": normalized_date,
+        "time": normalized_time,
+        "start": appointment_start(normalized_date, normalized_time),
+        "duration_minutes": APPOINTMENT_DURATION_MINUTES
+    }
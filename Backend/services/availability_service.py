@@ -0,0 +1,116 @@
+import json
+import os
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from typing import Optional
+from db import appointments
+from services.appointment_time import day_range, to_local
+
+# Calendario dell'ambulatorio: orari di apertura per giorno della settimana (0 = lunedì), durata di uno slot e giorni di chiusura.
+# CLINIC_OPENING_HOURS accetta un JSON del tipo {"0": [["09:00", "13:00"], ["14:00", "18:00"]], ...}
+DEFAULT_OPENING_HOURS = {
+    weekday: [["09:00", "13:00"], ["14:00", "18:00"]] for weekday in range(5)
+}
+CLINIC_SLOT_MINUTES = int(os.getenv("CLINIC_SLOT_MINUTES", "30"))
+# Date di chiusura separate da virgola, es. "2025-12-25,2026-01-01"
+CLINIC_CLOSURES = os.getenv("CLINIC_CLOSURES", "")
+# Orizzonte massimo di ricerca dei prossimi slot liberi e ampiezza dei blocchi di giorni letti dal db con una query
+AVAILABILITY_HORIZON_DAYS = int(os.getenv("AVAILABILITY_HORIZON_DAYS", "365"))
+AVAILABILITY_WINDOW_DAYS = int(os.getenv("AVAILABILITY_WINDOW_DAYS", "31"))
+
+def to_minutes(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def format_minutes(value: int) -> str:
+    return f"{value // 60:02d}:{value % 60:02d}"
+
+class ClinicCalendar:
+    """
+    Slot prenotabili di ogni giorno. Gli slot occupati di un giorno sono rappresentati da una bitmap:
+    il bit i è acceso se l'i-esimo slot del giorno è prenotato.
+    """
+
+    def __init__(self, opening_hours: dict, slot_minutes: int, closures: set):
+        self.slot_minutes = slot_minutes
+        self.closures = closures
+        # Inizio (in minuti dalla mezzanotte) di ogni slot, ordinati, per giorno della settimana
+        self._slots = {}
+        for weekday, intervals in opening_hours.items():
+            starts = []
+            for opening, closing in intervals:
+                starts.extend(range(to_minutes(opening), to_minutes(closing) - slot_minutes + 1, slot_minutes))
+            self._slots[int(weekday)] = tuple(sorted(starts))
+
+    def day_slots(self, day: date) -> tuple:
+        if day in self.closures:
+            return ()
+        return self._slots.get(day.weekday(), ())
+
+    def slot_index(self, day: date, minutes: int) -> Optional[int]:
+        # Slot che contiene l'orario indicato (anche se non allineato all'inizio dello slot)
+        slots = self.day_slots(day)
+        i = bisect_right(slots, minutes) - 1
+        if i >= 0 and minutes < slots[i] + self.slot_minutes:
+            return i
+        return None
+
+    def free_slots(self, day: date, occupied: int, after_minutes: int = -1) -> list:
+        return [
+            format_minutes(start)
+            for i, start in enumerate(self.day_slots(day))
+            if not (occupied >> i) & 1 and start > after_minutes
+        ]
+
+def _load_calendar() -> ClinicCalendar:
+    opening_hours = json.loads(os.getenv("CLINIC_OPENING_HOURS")) if os.getenv("CLINIC_OPENING_HOURS") else DEFAULT_OPENING_HOURS
+    closures = {date.fromisoformat(d.strip()) for d in CLINIC_CLOSURES.split(",") if d.strip()}
+    return ClinicCalendar(opening_hours, CLINIC_SLOT_MINUTES, closures)
+
+clinic_calendar = _load_calendar()
+
+async def load_occupied(start: date, end: date) -> dict:
+    """
+    Bitmap degli slot occupati per ogni giorno tra start ed end (inclusi), lette con un'unica scansione per intervallo sull'indice start.
+    """
+    cursor = appointments.find(day_range(start, end), {"_id": 0, "start": 1})
+
+    occupied = {}
+    async for appt in cursor:
+        local = to_local(appt["start"])
+        day = local.date()
+        minutes = local.hour * 60 + local.minute
+
+        i = clinic_calendar.slot_index(day, minutes)
+        if i is not None:
+            occupied[day] = occupied.get(day, 0) | (1 << i)
+
+    return occupied
+
+async def free_slots_on(day: date) -> list:
+    """
+    Orari liberi (HH:MM) in un giorno.
+    """
+    occupied = await load_occupied(day, day)
+    return clinic_calendar.free_slots(day, occupied.get(day, 0))
+
+async def next_free_slots(after: datetime, count: int) -> list:
+    """
+    Primi `count` slot liberi successivi all'istante `after`, entro AVAILABILITY_HORIZON_DAYS giorni.
+    """
+    result = []
+    day = after.date()
+    last_day = day + timedelta(days=AVAILABILITY_HORIZON_DAYS)
+    after_minutes = after.hour * 60 + after.minute
+
+    # I giorni vengono letti dal db a blocchi, fermandosi appena trovati abbastanza slot
+    while day <= last_day and len(result) < count:
+        window_end = min(day + timedelta(days=AVAILABILITY_WINDOW_DAYS - 1), last_day)
+        occupied = await load_occupied(day, window_end)
+
+        while day <= window_end and len(result) < count:
+            free = clinic_calendar.free_slots(day, occupied.get(day, 0), after_minutes if day == after.date() else -1)
+            result.extend({"date": day.isoformat(), "time": t} for t in free[:count - len(result)])
+            day += timedelta(days=1)
+
+    return result
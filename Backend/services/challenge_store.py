@@ -0,0 +1,89 @@
+import os
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional
+from db import mfa_challenges
+from services.cache import TTLCache
+
+# Sfide WebAuthn in corso, identificate da un id opaco (ceremony id) inviato al browser in un cookie.
+# Ogni sfida è monouso e scade dopo MFA_CHALLENGE_TTL secondi.
+# Backend: "mongo" (default, condiviso tra worker e istanze, collection con indice TTL) oppure "memory",
+# solo per un singolo processo: con più worker begin e complete possono arrivare a processi diversi e la sfida non si trova
+MFA_CHALLENGE_BACKEND = os.getenv("MFA_CHALLENGE_BACKEND", "mongo").lower()
+MFA_CHALLENGE_TTL = int(os.getenv("MFA_CHALLENGE_TTL", "300"))
+MFA_CHALLENGE_MAX = int(os.getenv("MFA_CHALLENGE_MAX", "10000"))
+
+
+class MemoryChallengeStore:
+    """
+    Sfide in memoria con scadenza: le cerimonie abbandonate vengono eliminate dal TTL o, se la cache è piena, dall'LRU.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def put(self, ceremony_id: str, challenge: dict):
+        self._cache.set(ceremony_id, challenge)
+
+    async def pop(self, ceremony_id: str) -> Optional[dict]:
+        # Nessun await tra lettura e rimozione: sull'event loop la pop è atomica
+        challenge = self._cache.get(ceremony_id)
+        self._cache.invalidate(ceremony_id)
+        return challenge
+
+
+class MongoChallengeStore:
+    """
+    Sfide nella collection mfa_challenges: l'indice TTL su expires_at elimina quelle abbandonate.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    async def put(self, ceremony_id: str, challenge: dict):
+        await mfa_challenges.insert_one({
+            "_id": ceremony_id,
+            **challenge,
+            "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)
+        })
+
+    async def pop(self, ceremony_id: str) -> Optional[dict]:
+        # find_one_and_delete rende la sfida monouso anche tra più worker. Il monitor TTL passa ogni ~60 secondi:
+        # la scadenza viene quindi controllata anche qui
+        challenge = await mfa_challenges.find_one_and_delete(
+            {"_id": ceremony_id, "expires_at": {"$gt": datetime.utcnow()}},
+            projection={"_id": 0, "expires_at": 0}
+        )
+        return challenge
+
+
+if MFA_CHALLENGE_BACKEND == "memory":
+    challenge_store = MemoryChallengeStore(MFA_CHALLENGE_MAX, MFA_CHALLENGE_TTL)
+else:
+    challenge_store = MongoChallengeStore(MFA_CHALLENGE_TTL)
+
+
+async def start_ceremony(user_id: str, kind: str, state: dict) -> str:
+    """
+    Salva la sfida di una cerimonia (kind = "register" o "login") e ritorna il suo id opaco.
+    """
+    ceremony_id = secrets.token_urlsafe(32)
+    await challenge_store.put(ceremony_id, {"user_id": user_id, "kind": kind, "state": state})
+    return ceremony_id
+
+
+async def finish_ceremony(ceremony_id: Optional[str], kind: str) -> Optional[dict]:
+    """
+    Consuma la sfida: ritorna {"user_id", "state"} se esiste, non è scaduta ed è del tipo atteso, altrimenti None.
+    """
+    if not ceremony_id:
+        return None
+    challenge = await challenge_store.pop(ceremony_id)
+    if not challenge or challenge.get("kind") != kind:
+        return None
+    return challenge
+
+
+async def cancel_ceremony(ceremony_id: Optional[str]):
+    if ceremony_id:
+        await challenge_store.pop(ceremony_id)
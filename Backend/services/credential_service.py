@@ -0,0 +1,92 @@
+import base64
+import os
+from typing import Optional, Tuple
+import cbor2
+from fido2.cose import CoseKey
+from fido2.webauthn import AttestedCredentialData, PublicKeyCredentialDescriptor, PublicKeyCredentialType
+from db import users
+from services.cache import TTLCache
+
+# Credenziali WebAuthn già decodificate (cbor2 + CoseKey), per (user_id, credential_id): le chiavi non cambiano dopo la
+# registrazione, il TTL limita solo quanto a lungo un processo può tenere in memoria una credenziale rimossa da un altro worker.
+# Ogni voce conserva anche la chiave pubblica codificata da cui è stata decodificata, confrontata con il record letto dal db:
+# la cache non può mai restituire una chiave diversa da quella salvata per quell'utente
+CREDENTIAL_CACHE_SIZE = int(os.getenv("CREDENTIAL_CACHE_SIZE", "10000"))
+CREDENTIAL_CACHE_TTL = float(os.getenv("CREDENTIAL_CACHE_TTL", "3600"))
+credential_cache = TTLCache(maxsize=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+descriptor_cache = TTLCache(maxsize=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+
+
+def websafe_b64decode(data: str) -> bytes:
+    padding = '=' * ((4 - len(data) % 4) % 4)
+    return base64.urlsafe_b64decode(data + padding)
+
+def websafe_b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def credential_record(cred: AttestedCredentialData) -> dict:
+    """
+    Documento salvato in users.webauthn_credentials per una credenziale appena registrata.
+    """
+    return {
+        "credential_id": websafe_b64encode(cred.credential_id),
+        "public_key": base64.urlsafe_b64encode(cbor2.dumps(cred.public_key)).decode(),
+    }
+
+def parse_credential(record: dict) -> AttestedCredentialData:
+    return AttestedCredentialData.create(
+        aaguid=b"\x00" * 16,
+        credential_id=websafe_b64decode(record["credential_id"]),
+        public_key=CoseKey.parse(cbor2.loads(base64.urlsafe_b64decode(record["public_key"] + "==")))
+    )
+
+def get_credential(user_id: str, record: dict) -> AttestedCredentialData:
+    """
+    Credenziale decodificata di un record di webauthn_credentials dell'utente, dalla cache se già vista.
+    """
+    key = (user_id, record["credential_id"])
+    cached = credential_cache.get(key)
+    if cached is not None and cached[0] == record["public_key"]:
+        return cached[1]
+    cred = parse_credential(record)
+    credential_cache.set(key, (record["public_key"], cred))
+    return cred
+
+def remember_credential(user_id: str, record: dict, cred: AttestedCredentialData):
+    # Dopo register_complete: la credenziale appena verificata e salvata entra in cache insieme al suo record
+    key = (user_id, record["credential_id"])
+    credential_cache.invalidate(key)
+    descriptor_cache.invalidate(record["credential_id"])
+    credential_cache.set(key, (record["public_key"], cred))
+
+def credential_descriptor(record: dict) -> PublicKeyCredentialDescriptor:
+    # Per escludere le chiavi già registrate basta il credential_id: la chiave pubblica non va decodificata.
+    # Anche i descriptor sono in cache: la costruzione dei dataclass di fido2 costa quanto la decodifica della chiave
+    descriptor = descriptor_cache.get(record["credential_id"])
+    if descriptor is None:
+        descriptor = PublicKeyCredentialDescriptor(
+            type=PublicKeyCredentialType.PUBLIC_KEY,
+            id=websafe_b64decode(record["credential_id"])
+        )
+        descriptor_cache.set(record["credential_id"], descriptor)
+    return descriptor
+
+
+async def find_credential_owner(credential_id: str) -> Tuple[Optional[dict], Optional[AttestedCredentialData]]:
+    """
+    Utente proprietario della credenziale e credenziale decodificata, con una sola lettura sull'indice
+    webauthn_credentials.credential_id. La proiezione posizionale restituisce solo la credenziale usata.
+    """
+    user = await users.find_one(
+        {"webauthn_credentials.credential_id": credential_id},
+        {"email": 1, "webauthn_credentials.$": 1}
+    )
+    if not user:
+        return None, None
+    return user, get_credential(str(user["_id"]), user["webauthn_credentials"][0])
+
+
+async def credential_exists(credential_id: str) -> bool:
+    # Un credential_id appartiene a una sola chiave di un solo utente (indice unique webauthn_credential_id)
+    return await users.find_one({"webauthn_credentials.credential_id": credential_id}, {"_id": 1}) is not None
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from db import messages
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Ruolo con cui vengono salvate le risposte dell'agente (lo stesso usato dal frontend)
+ASSISTANT_ROLE = "ai_medical_assistant"
+MESSAGE_ROLES = ("user", ASSISTANT_ROLE)
+# Lunghezza massima del testo di un messaggio: un documento oltre il limite BSON (16 MB) farebbe fallire l'intero blocco
+MESSAGE_MAX_CHARS = int(os.getenv("MESSAGE_MAX_CHARS", "20000"))
+
+# Scrittura differita dei messaggi: i documenti vengono accodati in memoria e scritti a blocchi con insert_many
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.5"))
+# Attesa massima per un posto in coda quando è piena, oltre la quale il messaggio viene rifiutato
+MESSAGE_ENQUEUE_TIMEOUT = float(os.getenv("MESSAGE_ENQUEUE_TIMEOUT", "2"))
+
+_STOP = object()
+
+class MessageQueueFullError(Exception):
+    """
+    Sollevata quando la coda dei messaggi resta piena oltre MESSAGE_ENQUEUE_TIMEOUT.
+    """
+
+class InvalidMessageError(ValueError):
+    """
+    Sollevata per un messaggio con ruolo non ammesso o testo mancante o troppo lungo.
+    """
+
+def validate_message(doc: dict):
+    if doc.get("role") not in MESSAGE_ROLES:
+        raise InvalidMessageError(f"role deve essere uno tra {', '.join(MESSAGE_ROLES)}")
+    content = doc.get("content")
+    if not isinstance(content, str):
+        raise InvalidMessageError("content deve essere una stringa")
+    if len(content) > MESSAGE_MAX_CHARS:
+        raise InvalidMessageError(f"content supera {MESSAGE_MAX_CHARS} caratteri")
+
+class MessageSink:
+    """
+    Coda limitata in memoria svuotata da un task in background che scrive i messaggi
+    con insert_many(ordered=False), a blocchi di al massimo batch_size documenti o ogni flush_interval secondi.
+    """
+
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float, enqueue_timeout: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._task = None
+        # Metriche
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batch_sizes = deque(maxlen=1000)
+        self.flush_latencies = deque(maxlen=1000)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Scrive tutti i messaggi ancora in coda e ferma il task (da chiamare allo shutdown).
+        """
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def put(self, *docs: dict):
+        # I messaggi vengono validati prima di entrare in coda: un documento non scrivibile non deve arrivare al task
+        for doc in docs:
+            validate_message(doc)
+
+        # Senza task attivo (es. script o avvio fallito) i messaggi vengono scritti subito
+        if self._task is None:
+            await messages.insert_many(list(docs), ordered=False)
+            return
+
+        for doc in docs:
+            try:
+                await asyncio.wait_for(self._queue.put(doc), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise MessageQueueFullError()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            doc = await self._queue.get()
+            if doc is _STOP:
+                break
+
+            # Si raccolgono altri documenti fino alla dimensione del blocco o allo scadere dell'intervallo
+            batch = [doc]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if doc is _STOP:
+                    stopping = True
+                    break
+                batch.append(doc)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            await messages.insert_many(batch, ordered=False)
+            self.written += len(batch)
+        except Exception as e:
+            # Qualsiasi errore (anche lato client, es. DocumentTooLarge che non è un PyMongoError) resta confinato
+            # al blocco: il task non deve terminare, altrimenti la coda non verrebbe più svuotata.
+            # Con ordered=False gli altri documenti del blocco vengono comunque scritti
+            write_errors = getattr(e, "details", None) or {}
+            failed = len(write_errors.get("writeErrors", [])) or len(batch)
+            self.failed += failed
+            self.written += len(batch) - failed
+            logger.error("Errore nella scrittura dei messaggi", extra={"failed": failed, "error": str(e)})
+
+        self.batches += 1
+        self.batch_sizes.append(len(batch))
+        self.flush_latencies.append(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        sizes = list(self.batch_sizes)
+        latencies = sorted(self.flush_latencies)
+        return {
+            "queue_depth": self._queue.qsize(),
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_batch_size": sum(sizes) / len(sizes) if sizes else None,
+            "flush_latency_p50": latencies[len(latencies) // 2] if latencies else None,
+            "flush_latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
+
+message_sink = MessageSink(
+    maxsize=MESSAGE_QUEUE_SIZE,
+    batch_size=MESSAGE_BATCH_SIZE,
+    flush_interval=MESSAGE_FLUSH_INTERVAL,
+    enqueue_timeout=MESSAGE_ENQUEUE_TIMEOUT
+)
+
+def message_doc(user_id: str, role: str, content: str, created_at: datetime = None) -> dict:
+    return {
+        "user_id": user_id,
+        "role": role,
+        "content": content,
+        "created_at": created_at or datetime.utcnow()
+    }
+
+async def save_turn(user_id: str, user_message: str, reply: str, user_created_at: datetime):
+    """
+    Accoda il messaggio dell'utente e la risposta dell'agente di un turno di chat.
+    Viene eseguita dopo l'invio della risposta, fuori dal percorso critico della richiesta.
+    """
+    docs = [message_doc(user_id, "user", user_message, user_created_at)]
+    if reply:
+        # La risposta viene troncata invece di perdere l'intero turno
+        docs.append(message_doc(user_id, ASSISTANT_ROLE, reply[:MESSAGE_MAX_CHARS]))
+
+    try:
+        await message_sink.put(*docs)
+    except Exception:
+        logger.exception("Errore nel salvataggio dei messaggi della chat", extra={"user_id": user_id})
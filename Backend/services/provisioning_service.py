@@ -0,0 +1,171 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from db import provisioning_jobs, user_agents
+from services.agent_service import get_or_create_agent, agent_cache
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Pre-creazione in background degli agenti Letta dopo registrazione/login, così il primo messaggio trova l'agente pronto.
+# La coda è su Mongo: i job sopravvivono ai riavvii e più worker possono consumarla.
+AGENT_PREPROVISION = os.getenv("AGENT_PREPROVISION", "false").lower() == "true"
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "2"))
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "5"))
+PROVISIONING_BACKOFF_BASE = float(os.getenv("PROVISIONING_BACKOFF_BASE", "2"))
+PROVISIONING_BACKOFF_MAX = float(os.getenv("PROVISIONING_BACKOFF_MAX", "300"))
+# Un job preso in carico e non completato entro questo tempo (es. worker riavviato) torna disponibile
+PROVISIONING_LEASE = float(os.getenv("PROVISIONING_LEASE", "180"))
+PROVISIONING_POLL_INTERVAL = float(os.getenv("PROVISIONING_POLL_INTERVAL", "5"))
+
+_wakeup = asyncio.Event()
+_workers = []
+# Accodamenti in corso avviati da schedule_agent_provisioning: il riferimento evita che il task venga raccolto dal GC
+_pending_enqueues = set()
+
+# Metriche: durata delle ultime creazioni e attesa complessiva dalla richiesta al completamento
+provisioning_durations = deque(maxlen=1000)
+provisioning_latencies = deque(maxlen=1000)
+provisioning_counters = {"completed": 0, "retried": 0, "failed": 0}
+
+async def enqueue_agent_provisioning(user_id: str, email: str):
+    """
+    Accoda la creazione dell'agente dell'utente, se la pre-creazione è attiva e l'agente non esiste ancora.
+    """
+    if not AGENT_PREPROVISION or agent_cache.get(user_id):
+        return
+
+    existing = await user_agents.find_one({"user_id": user_id}, {"agent_id": 1})
+    if existing and existing.get("agent_id"):
+        return
+
+    now = datetime.utcnow()
+    # Un job fallito definitivamente (es. Letta non raggiungibile per un po') torna in coda al login successivo
+    await provisioning_jobs.update_one(
+        {"user_id": user_id, "status": "failed"},
+        {"$set": {"status": "pending", "attempts": 0, "next_run_at": now, "created_at": now}}
+    )
+    # Un solo job per utente (user_id unique): accodamenti ripetuti non creano duplicati
+    await provisioning_jobs.update_one(
+        {"user_id": user_id},
+        {"$setOnInsert": {
+            "email": email,
+            "status": "pending",
+            "attempts": 0,
+            "next_run_at": now,
+            "created_at": now
+        }},
+        upsert=True
+    )
+    _wakeup.set()
+
+def _enqueue_done(task: asyncio.Task):
+    _pending_enqueues.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning("Accodamento del provisioning non riuscito", extra={"error": type(task.exception()).__name__})
+
+def schedule_agent_provisioning(user_id: str, email: str):
+    """
+    Accoda la creazione dell'agente in background, senza far attendere la risposta della route che la chiama.
+    """
+    if not AGENT_PREPROVISION:
+        return
+    task = asyncio.create_task(enqueue_agent_provisioning(user_id, email))
+    _pending_enqueues.add(task)
+    task.add_done_callback(_enqueue_done)
+
+async def _claim_job():
+    now = datetime.utcnow()
+    return await provisioning_jobs.find_one_and_update(
+        {"status": {"$in": ["pending", "running"]}, "next_run_at": {"$lte": now}},
+        {
+            "$set": {"status": "running", "next_run_at": now + timedelta(seconds=PROVISIONING_LEASE)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("next_run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def _run_job(job: dict):
+    started = time.perf_counter()
+    try:
+        await get_or_create_agent(job["user_id"], job["email"])
+    except Exception as e:
+        if job["attempts"] >= PROVISIONING_MAX_ATTEMPTS:
+            provisioning_counters["failed"] += 1
+            await provisioning_jobs.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"status": "failed", "last_error": str(e)}}
+            )
+            logger.error("Creazione agente fallita definitivamente", extra={"user_id": job["user_id"], "error": str(e)})
+            return
+
+        # Backoff esponenziale con jitter prima del prossimo tentativo
+        delay = min(PROVISIONING_BACKOFF_MAX, PROVISIONING_BACKOFF_BASE * 2 ** (job["attempts"] - 1))
+        delay = random.uniform(delay / 2, delay)
+        provisioning_counters["retried"] += 1
+        await provisioning_jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {
+                "status": "pending",
+                "next_run_at": datetime.utcnow() + timedelta(seconds=delay),
+                "last_error": str(e)
+            }}
+        )
+        return
+
+    await provisioning_jobs.delete_one({"_id": job["_id"]})
+    provisioning_counters["completed"] += 1
+    provisioning_durations.append(time.perf_counter() - started)
+    provisioning_latencies.append((datetime.utcnow() - job["created_at"]).total_seconds())
+
+async def _worker_loop():
+    while True:
+        try:
+            job = await _claim_job()
+        except Exception:
+            logger.exception("Errore nella lettura della coda di creazione agenti")
+            job = None
+
+        if job:
+            await _run_job(job)
+            continue
+
+        # Coda vuota: si attende un nuovo job o il prossimo controllo periodico (retry e lease scadute)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=PROVISIONING_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_provisioning_workers():
+    if not AGENT_PREPROVISION or _workers:
+        return
+    for _ in range(PROVISIONING_WORKERS):
+        _workers.append(asyncio.create_task(_worker_loop()))
+
+async def stop_provisioning_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+async def provisioning_metrics() -> dict:
+    """
+    Profondità della coda e statistiche sui tempi di creazione degli agenti.
+    """
+    durations = sorted(provisioning_durations)
+    latencies = sorted(provisioning_latencies)
+    return {
+        "queue_depth": await provisioning_jobs.count_documents({"status": {"$in": ["pending", "running"]}}),
+        "failed_jobs": await provisioning_jobs.count_documents({"status": "failed"}),
+        **provisioning_counters,
+        "duration_p50": durations[len(durations) // 2] if durations else None,
+        "duration_p99": durations[int(len(durations) * 0.99)] if durations else None,
+        "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+        "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+    }
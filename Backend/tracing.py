@@ -0,0 +1,363 @@
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from pymongo import monitoring
+
+# Tracing distribuito di un turno di chat: /letta/ask -> Letta -> callback dei tool su /tool -> MongoDB.
+# Gli span vengono scritti in formato OTLP/JSON (una riga per batch) su TRACE_EXPORT_FILE da un thread in background,
+# così funziona anche offline; il file si può leggere con scripts/trace_report.py o importare in un collector OTLP.
+# Senza TRACE_EXPORT_FILE il tracing è disattivato e non viene creato nessuno span.
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+TRACING_ENABLED = bool(TRACE_EXPORT_FILE)
+# Frazione delle tracce registrate (decisa alla radice e propagata con il flag di traceparent)
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "medical-assistant-backend")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+
+# Kind degli span OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, kind: int, attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.status = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status = (STATUS_ERROR, message)
+
+    def traceparent(self) -> str:
+        # Formato W3C Trace Context: versione-trace_id-span_id-flag
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.sampled:
+                span_exporter.export(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status:
+            span["status"] = {"code": self.status[0], "message": self.status[1]}
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# Span attivo nel task corrente: è il padre degli span creati al suo interno (chiamate a Letta, comandi MongoDB)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+# user_id -> span del turno di chat in corso.
+# Limite noto: Letta non passa ai tool il contesto della richiesta, quindi con Letta vero le callback su /tool non hanno
+# un traceparent (TRACEPARENT esiste solo con scripts/stub_letta.py). Il middleware le collega allora, al meglio,
+# al turno attivo dell'utente indicato da X-Letta-User. Il collegamento è solo indicativo:
+# - la mappa è in memoria nel singolo processo: con più worker la callback arriva spesso a un processo diverso
+#   da quello del turno e resta una traccia a sé;
+# - X-Letta-User è un header scelto dal chiamante, usato solo per il tracing e mai per l'autorizzazione;
+# - due turni sovrapposti dello stesso utente non si distinguono.
+# Gli span collegati così hanno l'attributo trace.link = "active_turn".
+active_turns = {}
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple]:
+    """
+    (trace_id, span_id, sampled) da un header traceparent, None se assente o non valido.
+    """
+    if not value:
+        return None
+    parts = value.strip().lower().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    _, trace_id, span_id, flags = parts
+    try:
+        if not int(trace_id, 16) or not int(span_id, 16):
+            return None
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    return trace_id, span_id, sampled
+
+
+def new_span(name: str, parent=None, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Optional[Span]:
+    """
+    Crea uno span figlio di parent (uno Span o una tupla di parse_traceparent), altrimenti dello span attivo.
+    Senza padre inizia una nuova traccia. Restituisce None se il tracing è disattivato.
+    """
+    if not TRACING_ENABLED:
+        return None
+    if parent is None:
+        parent = current_span.get()
+    if isinstance(parent, Span):
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes)
+    if parent:
+        trace_id, parent_id, sampled = parent
+        return Span(name, trace_id, parent_id, sampled, kind, attributes)
+    sampled = TRACE_SAMPLE_RATIO >= 1 or random.random() < TRACE_SAMPLE_RATIO
+    return Span(name, secrets.token_hex(16), None, sampled, kind, attributes)
+
+
+@contextmanager
+def start_span(name: str, parent=None, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """
+    Apre uno span e lo rende attivo fino all'uscita dal blocco; un'eccezione lo marca come errore.
+    """
+    span = new_span(name, parent, kind, **attributes)
+    if span is None:
+        yield None
+        return
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(type(e).__name__)
+        raise
+    finally:
+        span.end()
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # Generatore chiuso da un contesto diverso da quello in cui era stato aperto
+            pass
+
+
+@contextmanager
+def chat_turn(user_id: str, **attributes):
+    """
+    Span di un turno di chat: genera il trace id del turno e lo rende visibile alle callback dei tool dell'utente.
+    """
+    with start_span("chat.turn", user_id=user_id, **attributes) as span:
+        if span is None:
+            yield None
+            return
+        previous = active_turns.get(user_id)
+        active_turns[user_id] = span
+        try:
+            yield span
+        finally:
+            if active_turns.get(user_id) is span:
+                if previous is None or previous.end_ns is not None:
+                    active_turns.pop(user_id, None)
+                else:
+                    active_turns[user_id] = previous
+
+
+@contextmanager
+def letta_span(operation: str, user_id: Optional[str] = None, **attributes):
+    """
+    Span client di una chiamata a Letta. Durante la chiamata le callback dei tool dell'utente diventano sue figlie:
+    è la chiamata a Letta che le genera.
+    """
+    with start_span(f"letta.{operation}", kind=SPAN_KIND_CLIENT, **attributes) as span:
+        turn = active_turns.get(user_id) if span and user_id else None
+        if turn is not None:
+            active_turns[user_id] = span
+        try:
+            yield span
+        finally:
+            if turn is not None and active_turns.get(user_id) is span:
+                active_turns[user_id] = turn
+
+
+def trace_headers(span: Optional[Span]) -> dict:
+    # Header da aggiungere alle richieste in uscita (vuoto se il tracing è disattivato)
+    return {"traceparent": span.traceparent()} if span else {}
+
+
+class SpanExporter:
+    """
+    Coda limitata di span completati, scritti in batch su file da un thread in background: l'event loop
+    non fa mai I/O per il tracing. Se la coda è piena gli span vengono scartati e contati.
+    """
+
+    def __init__(self, path: Optional[str], maxsize: int, batch_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        # Scrive gli span ancora in coda e ferma il thread
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "exported": self.exported, "dropped": self.dropped}
+
+    def _run(self):
+        resource = {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]}
+        with open(self.path, "a", encoding="utf-8") as f:
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stopping = True
+                    batch = [span for span in batch if span is not None]
+                if not batch:
+                    continue
+                line = {"resourceSpans": [{
+                    "resource": resource,
+                    "scopeSpans": [{"scope": {"name": "backend"}, "spans": [span.to_otlp() for span in batch]}]
+                }]}
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+                f.flush()
+                self.exported += len(batch)
+
+
+span_exporter = SpanExporter(TRACE_EXPORT_FILE, TRACE_QUEUE_SIZE, TRACE_BATCH_SIZE)
+
+
+class TracingMiddleware:
+    """
+    Middleware ASGI: uno span server per richiesta, figlio del traceparent ricevuto. Le callback dei tool su /tool
+    senza traceparent vengono collegate, al meglio, al turno di chat attivo dell'utente indicato nell'header
+    X-Letta-User in questo processo (vedi i limiti descritti su active_turns).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            return await self.app(scope, receive, send)
+
+        headers = {}
+        for key, value in scope["headers"]:
+            if key in (b"traceparent", b"x-letta-user"):
+                headers[key] = value.decode("latin-1")
+
+        is_tool_callback = scope["path"].startswith("/tool/")
+        parent = parse_traceparent(headers.get(b"traceparent"))
+        linked_to_turn = False
+        if parent is None and is_tool_callback:
+            parent = active_turns.get(headers.get(b"x-letta-user"))
+            linked_to_turn = parent is not None
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        with start_span(f"{scope['method']} {scope['path']}", parent=parent, kind=SPAN_KIND_SERVER) as span:
+            span.set_attribute("http.method", scope["method"])
+            if is_tool_callback:
+                span.set_attribute("tool.callback", True)
+            if linked_to_turn:
+                span.set_attribute("trace.link", "active_turn")
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                # Nome e attributo con il template della route, come per le metriche
+                route_path = getattr(scope.get("route"), "path", None)
+                if route_path:
+                    span.name = f"{scope['method']} {route_path}"
+                    span.set_attribute("http.route", route_path)
+                span.set_attribute("http.status_code", status[0])
+                if status[0] >= 500:
+                    span.set_error(f"HTTP {status[0]}")
+
+
+class MongoTraceListener(monitoring.CommandListener):
+    """
+    Uno span per ogni comando MongoDB eseguito dentro uno span attivo (le query fuori da una traccia sono ignorate).
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        parent = current_span.get()
+        if parent is None or not parent.sampled:
+            return
+        collection = event.command.get(event.command_name)
+        span = new_span(
+            f"mongo.{event.command_name}", parent=parent, kind=SPAN_KIND_CLIENT,
+            **{"db.system": "mongodb", "db.operation": event.command_name}
+        )
+        if isinstance(collection, str):
+            span.set_attribute("db.mongodb.collection", collection)
+        self._pending[(event.request_id, event.connection_id)] = span
+
+    def succeeded(self, event):
+        span = self._pending.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.end()
+
+    def failed(self, event):
+        span = self._pending.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.set_error(str(event.failure.get("errmsg", "")) if isinstance(event.failure, dict) else "failed")
+            span.end()
+
+
+mongo_trace_listener = MongoTraceListener()
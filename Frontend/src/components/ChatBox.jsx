@@ -1,4 +1,4 @@
-import React, { useState, useRef, useEffect } from 'react';
+import React, { useState, useRef, useEffect, useLayoutEffect } from 'react';
 import { Container, Button, Form, Spinner } from 'react-bootstrap';
 import axios from 'axios';
 import { useUser } from '../contexts/UserContext';
@@ -8,17 +8,36 @@ const ChatBox = () => {
     const [input, setInput] = useState("");
     const [messages, setMessages] = useState([]);
     const [loading, setLoading] = useState(false);
+    const [status, setStatus] = useState("");   // avanzamento dell'agente (ragionamento, tool in uso)
+
+    const [hasMore, setHasMore] = useState(false);          // ci sono messaggi più vecchi da caricare
+    const [olderCursor, setOlderCursor] = useState(null);   // cursore della pagina precedente
+    const [loadingOlder, setLoadingOlder] = useState(false);
 
     const messagesEndRef = useRef(null); // ref al fondo della chat
+    const containerRef = useRef(null);
+    const prependScrollRef = useRef(null); // altezza della chat prima di aggiungere messaggi in cima
 
     const scrollToBottom = () => {
         messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
     };
 
+    // Carica una pagina dello storico: senza cursore le ultime, con cursore quelle precedenti
+    const fetchMessages = (before) => {
+        return axios.get("https://the-secure-ai-medical-assistant.onrender.com/frontend/messages", {
+            params: before ? { before } : {},
+            withCredentials: true
+        }).then((res) => {
+            setHasMore(Boolean(res.data.has_more));
+            setOlderCursor(res.data.before || null);
+            return res.data.messages || [];
+        });
+    };
+
     useEffect(() => {
-        axios.get("https://the-secure-ai-medical-assistant.onrender.com/frontend/messages", { withCredentials: true })
-            .then((res) => {
-                setMessages(res.data.messages || []);
+        fetchMessages()
+            .then((page) => {
+                setMessages(page);
             })
             .catch((err) => {
                 console.error("Errore nel recupero messaggi", err);
@@ -28,22 +47,76 @@ const ChatBox = () => {
             });
     }, []);
 
-    useEffect(() => {
+    const loadOlderMessages = () => {
+        if (!hasMore || loadingOlder || !olderCursor) return;
+
+        setLoadingOlder(true);
+        fetchMessages(olderCursor)
+            .then((page) => {
+                prependScrollRef.current = containerRef.current.scrollHeight - containerRef.current.scrollTop;
+                setMessages(prev => [...page, ...prev]);
+            })
+            .catch((err) => {
+                console.error("Errore nel recupero messaggi", err);
+            })
+            .finally(() => {
+                setLoadingOlder(false);
+            });
+    };
+
+    // Quando si arriva in cima alla chat si caricano i messaggi più vecchi
+    const handleScroll = (e) => {
+        if (e.currentTarget.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    };
+
+    useLayoutEffect(() => {
+        // Dopo aver aggiunto messaggi in cima si mantiene la posizione di lettura invece di scendere in fondo
+        if (prependScrollRef.current !== null) {
+            containerRef.current.scrollTop = containerRef.current.scrollHeight - prependScrollRef.current;
+            prependScrollRef.current = null;
+            return;
+        }
         scrollToBottom();
     }, [messages]);
 
-    const saveMessage = (message) => {
-        return axios.post(
-            "https://the-secure-ai-medical-assistant.onrender.com/frontend/messages",
-            {
-                role: message.role,
-                content: message.content
-            },
-            { withCredentials: true }
-        );
+    // Legge lo stream Server-Sent Events di /letta/ask/stream e chiama onEvent per ogni evento ricevuto
+    const streamAgentReply = async (message, onEvent) => {
+        const response = await fetch("https://the-secure-ai-medical-assistant.onrender.com/letta/ask/stream", {
+            method: "POST",
+            credentials: "include",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ message })
+        });
+
+        if (!response.ok || !response.body || !response.headers.get("content-type")?.startsWith("text/event-stream")) {
+            throw new Error(`Errore HTTP ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+
+            // Gli eventi SSE sono separati da una riga vuota
+            const events = buffer.split("\n\n");
+            buffer = events.pop();
+
+            for (const rawEvent of events) {
+                const dataLine = rawEvent.split("\n").find((line) => line.startsWith("data: "));
+                if (dataLine) {
+                    onEvent(JSON.parse(dataLine.slice(6)));
+                }
+            }
+        }
     };
 
-
     const sendMessage = () => {
         if (!input.trim()) return;
 
@@ -52,24 +125,41 @@ const ChatBox = () => {
         setMessages(prev => [...prev, userMessage]);
         setInput("");
 
-        saveMessage(userMessage)
-
+        // Il backend salva sia il messaggio dell'utente sia la risposta dell'agente
         setLoading(true);
-
-        axios.post("https://the-secure-ai-medical-assistant.onrender.com/letta/ask", { message: messageToSend }, { withCredentials: true })
-            .then((res) => {
-                const aiMessage = { role: 'ai_medical_assistant', content: res.data.response };
-                setMessages(prev => [...prev, aiMessage]);
-                saveMessage(aiMessage)
-                //console.log(messages)
-            })
+        setStatus("");
+
+        // Il messaggio dell'assistente viene aggiunto vuoto e completato man mano che arrivano i token
+        let aiContent = "";
+        setMessages(prev => [...prev, { role: 'ai_medical_assistant', content: "" }]);
+
+        const updateAiMessage = (content) => {
+            setMessages(prev => [...prev.slice(0, -1), { role: 'ai_medical_assistant', content }]);
+        };
+
+        streamAgentReply(messageToSend, (event) => {
+            if (event.type === "token") {
+                aiContent += event.content;
+                updateAiMessage(aiContent);
+                setStatus("");
+            } else if (event.type === "reasoning") {
+                setStatus("Sto pensando...");
+            } else if (event.type === "tool_call") {
+                setStatus(`Sto usando lo strumento ${event.name}...`);
+            } else if (event.type === "tool_return") {
+                setStatus("");
+            } else if (event.type === "error") {
+                aiContent = event.content;
+                updateAiMessage(aiContent);
+            }
+        })
             .catch((err) => {
                 console.error(err);
-                const errorMessage = { role: 'ai', content: "Errore nel server, riprova." };
-                setMessages(prev => [...prev, errorMessage]);
+                updateAiMessage("Errore nel server, riprova.");
             })
             .finally(() => {
                 setLoading(false);
+                setStatus("");
             });
     };
 
@@ -79,8 +169,15 @@ const ChatBox = () => {
             <div
                 className="chat-messages mb-3 p-3 border rounded"
                 style={{ maxHeight: "400px", overflowY: "auto", background: "#f8f9fa" }}
+                ref={containerRef}
+                onScroll={handleScroll}
             >
-                {messages.map((msg, idx) => (
+                {loadingOlder && (
+                    <div className="d-flex justify-content-center mb-2">
+                        <Spinner animation="border" size="sm" />
+                    </div>
+                )}
+                {messages.map((msg, idx) => msg.content && (
                     <div
                         key={idx}
                         className={`d-flex mb-2 ${msg.role === 'user' ? 'justify-content-end' : 'justify-content-start'}`}
@@ -108,6 +205,7 @@ const ChatBox = () => {
                         >
                             <span className="visually-hidden">Loading...</span>
                         </Spinner>
+                        {status && <small className="text-muted">{status}</small>}
                     </div>
                 )}
                 <div ref={messagesEndRef} />